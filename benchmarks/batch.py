@@ -0,0 +1,81 @@
+# Numeric aggregations, per-record steps vs. vectorized batch steps (needs numpy)
+# the batch steps get the input as arrays, converting Python records costs about as much as the steps
+# run: python -m benchmarks.batch [records]
+import sys
+import time
+
+import numpy as np
+
+from mapreduce import MapReduceTask, Columns
+from benchmarks import generators
+
+
+def sum_by_key(records):
+    keys = generators.keys(records, 1000, 'zipf')
+    values = generators.points(records)
+
+    t = MapReduceTask(verbose=False)
+
+    @t.map
+    def m1(k, v):
+        yield keys[k], v
+
+    t.aggregate('sum')
+
+    b = MapReduceTask(verbose=False)
+    b.aggregate_batch('sum')
+    columns = Columns(keys, values)
+
+    return (lambda: t(values)), (lambda: b(columns))
+
+
+def k_means_step(records, centers=(2.0, 8.0, 13.0)):
+    # assigns every point to the nearest center, the new centers are the means
+    values = generators.points(records)
+
+    t = MapReduceTask(verbose=False)
+
+    @t.map
+    def m1(k, point):
+        yield min(range(len(centers)), key=lambda i: abs(point - centers[i])), point
+
+    t.aggregate('mean')
+
+    b = MapReduceTask(verbose=False)
+    c = np.array(centers)
+
+    @b.map_batch
+    def nearest(keys, points):
+        return np.abs(points[:, None] - c).argmin(axis=1), points
+
+    b.aggregate_batch('mean')
+
+    columns = Columns(values=values)
+    return (lambda: t(values)), (lambda: b(columns))
+
+
+BENCHMARKS = {
+    'sum_by_key': sum_by_key,
+    'k_means_step': k_means_step,
+}
+
+
+def measure(run):
+    start = time.perf_counter()
+    result = dict(run())
+    return time.perf_counter() - start, result
+
+
+def run(records):
+    print('records={}'.format(records))
+    for name, benchmark in BENCHMARKS.items():
+        per_record, batch = benchmark(records)
+        per_record_time, expected = measure(per_record)
+        batch_time, result = measure(batch)
+        assert result.keys() == expected.keys()
+        print('{:13} per record {:.3f}s, batch {:.3f}s, {:.1f}x'.format(
+            name + ':', per_record_time, batch_time, per_record_time / batch_time))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10 ** 6)
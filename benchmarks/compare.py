@@ -0,0 +1,27 @@
+# Compares two result files of benchmarks.run
+# python -m benchmarks.compare old.jsonl new.jsonl
+import json
+import sys
+
+KEY = ('workload', 'records', 'distribution', 'lazy', 'verbose')
+
+
+def load(path):
+    with open(path) as f:
+        return {tuple(r[k] for k in KEY): r for r in map(json.loads, f) if r}
+
+
+def main(old_path, new_path):
+    old, new = load(old_path), load(new_path)
+    print('{:16} {:>9} {:>5} {:>7} {:>10} {:>10} {:>7} {:>9}'.format(
+        'workload', 'records', 'lazy', 'verbose', 'old s', 'new s', 'speedup', 'rss MB'))
+    for key in sorted(set(old) & set(new), key=str):
+        o, n = old[key], new[key]
+        print('{:16} {:>9} {:>5} {:>7} {:>10.3f} {:>10.3f} {:>6.2f}x {:>9}'.format(
+            key[0], key[1], str(key[3]), str(key[4]), o['seconds'], n['seconds'],
+            o['seconds'] / n['seconds'],
+            '{:.0f}->{:.0f}'.format(o['peak_rss_mb'], n['peak_rss_mb']) if n['peak_rss_mb'] else '-'))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
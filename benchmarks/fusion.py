@@ -0,0 +1,44 @@
+# Per-record overhead of chained map steps, fused vs. not fused
+# run: python -m benchmarks.fusion [records] [steps]
+import sys
+import time
+import tracemalloc
+
+from mapreduce import MapReduceTask
+
+
+def chain(n_steps, fuse):
+    t = MapReduceTask(verbose=False, fuse=fuse)
+    for _ in range(n_steps):
+        @t.map
+        def step(k, v):
+            yield k, v + 1
+    return t
+
+
+def run(records, n_steps):
+    x = range(records)
+    results = {}
+    peaks = {}
+    for fuse in [False, True]:
+        t = chain(n_steps, fuse)
+        start = time.perf_counter()
+        list(t(x))
+        results[fuse] = time.perf_counter() - start
+        # memory is measured in a separate run, tracemalloc slows everything down
+        tracemalloc.start()
+        list(t(x))
+        peaks[fuse] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    unfused, fused = results[False], results[True]
+    print('records={} steps={}'.format(records, n_steps))
+    for name, fuse in [('not fused', False), ('fused', True)]:
+        print('{:10} {:.3f}s, {:.0f} ns/record/step, peak {:.1f} MB'.format(
+            name + ':', results[fuse], results[fuse] / records / n_steps * 1e9, peaks[fuse] / 2 ** 20))
+    print('saved:     {:.0f} ns/record/step'.format((unfused - fused) / records / n_steps * 1e9))
+
+
+if __name__ == '__main__':
+    records = int(sys.argv[1]) if len(sys.argv) > 1 else 10 ** 6
+    n_steps = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    run(records, n_steps)
@@ -0,0 +1,66 @@
+# Synthetic data generators for the benchmarks, all of them are deterministic for a given seed
+import bisect
+import itertools
+import random
+
+
+def zipf_weights(n_keys, s=1.1):
+    return [1 / (i ** s) for i in range(1, n_keys + 1)]
+
+
+def keys(n, n_keys, distribution='uniform', seed=0):
+    # n keys from range(n_keys), either uniform or zipf distributed (0 is the most frequent)
+    rnd = random.Random(seed)
+    if distribution == 'uniform':
+        return [rnd.randrange(n_keys) for _ in range(n)]
+    if distribution == 'zipf':
+        cum_weights = list(itertools.accumulate(zipf_weights(n_keys)))
+        total = cum_weights[-1]
+        return [bisect.bisect(cum_weights, rnd.random() * total) for _ in range(n)]
+    raise ValueError('unknown distribution: {}'.format(distribution))
+
+
+def text_lines(n_words, words_per_line=10, vocabulary=10000, distribution='zipf', seed=0):
+    words = keys(n_words, vocabulary, distribution, seed)
+    lines = []
+    for i in range(0, n_words, words_per_line):
+        lines.append(' '.join('w{}'.format(w) for w in words[i:i + words_per_line]))
+    return lines
+
+
+def random_graph(n_edges, avg_degree=5, distribution='uniform', seed=0):
+    # directed graph as {node: [neighbors]}, every node has at least one outgoing link
+    rnd = random.Random(seed)
+    n_nodes = max(2, n_edges // avg_degree)
+    targets = keys(n_edges, n_nodes, distribution, seed + 1)
+    graph = {'n{}'.format(n): [] for n in range(n_nodes)}
+    for t in targets:
+        graph['n{}'.format(rnd.randrange(n_nodes))].append('n{}'.format(t))
+    for node, neighbors in graph.items():
+        if not neighbors:
+            neighbors.append('n{}'.format(rnd.randrange(n_nodes)))
+    return graph
+
+
+def relations(n, n_keys, distribution='uniform', seed=0):
+    # two relations [(key, value)] of n/2 records each, the distribution applies to the left one,
+    # the keys of the right one are unique like in a dimension table
+    left = keys(n // 2, n_keys, distribution, seed)
+    right = list(range(n_keys)) * ((n - n // 2) // n_keys + 1)
+    right = right[:n - n // 2]
+    return list(zip(left, range(len(left)))), list(zip(right, range(len(right))))
+
+
+def sparse_matrix(rows, cols, nnz, seed=0):
+    # [(row, col, value)] with 1-based indices, like in the matrix product example
+    rnd = random.Random(seed)
+    cells = set()
+    nnz = min(nnz, rows * cols)
+    while len(cells) < nnz:
+        cells.add((rnd.randint(1, rows), rnd.randint(1, cols)))
+    return [(r, c, rnd.randint(1, 9)) for r, c in sorted(cells)]
+
+
+def points(n, centers=(2, 8, 13), spread=1.0, seed=0):
+    rnd = random.Random(seed)
+    return [rnd.gauss(centers[i % len(centers)], spread) for i in range(n)]
@@ -0,0 +1,123 @@
+"""Benchmark suite: runs the example workloads on synthetic data and writes one json line per case.
+
+    python -m benchmarks.run --sizes 10000,100000,1000000 --output results.jsonl
+
+Every case runs in a separate process, so the peak RSS is measured per case.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from benchmarks.workloads import WORKLOADS
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / 2 ** 20  # bytes
+    return rss / 2 ** 10  # kilobytes
+
+
+def step_times(tasks):
+    # wall time per step, summed over the iterations of repeated blocks
+    times = {}
+
+    def add(stats, prefix=''):
+        for s in stats:
+            name = prefix + s['step']
+            times[name] = times.get(name, 0.0) + s['wall']
+            for iteration in s.get('iterations', []):
+                add(iteration, name + '/')
+            add(s.get('steps', []), name + '/')
+
+    for i, task in enumerate(tasks):
+        add(task.stats(), '' if len(tasks) == 1 else 'task{}/'.format(i))
+    return times
+
+
+def run_case(case):
+    options = dict(verbose=case['verbose'], lazy=case['lazy'], collect_stats=case['step_stats'])
+    run = WORKLOADS[case['workload']](case['records'], case['distribution'], options)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        output, tasks = run()
+        seconds = time.perf_counter() - start
+    result = dict(case)
+    result.update({
+        'python': platform.python_version(),
+        'seconds': seconds,
+        'throughput': case['records'] / seconds,
+        'peak_rss_mb': peak_rss_mb(),
+        'output_records': len(output),
+    })
+    if case['step_stats']:
+        result['steps'] = step_times(tasks)
+    return result
+
+
+def cases(args):
+    for workload in args.workloads.split(','):
+        for records in map(int, args.sizes.split(',')):
+            for mode in args.modes.split(','):
+                for verbose in args.verbose.split(','):
+                    if verbose == 'on' and records > args.max_verbose_records:
+                        continue
+                    yield {
+                        'workload': workload,
+                        'records': records,
+                        'distribution': args.distribution,
+                        'lazy': mode == 'lazy',
+                        'verbose': verbose == 'on',
+                        'step_stats': not args.no_step_stats,
+                    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workloads', default=','.join(WORKLOADS))
+    parser.add_argument('--sizes', default='10000,100000')
+    parser.add_argument('--distribution', default='zipf', choices=['uniform', 'zipf'])
+    parser.add_argument('--modes', default='eager,lazy')
+    parser.add_argument('--verbose', default='off,on')
+    parser.add_argument('--max-verbose-records', type=int, default=100000,
+                        help='skip verbose runs on larger inputs')
+    parser.add_argument('--no-step-stats', action='store_true',
+                        help="don't collect per step times (collect_stats has some overhead)")
+    parser.add_argument('--output', help='append json lines to this file instead of stdout')
+    parser.add_argument('--case', help=argparse.SUPPRESS)  # internal, run a single case
+    args = parser.parse_args(argv)
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return
+
+    out = open(args.output, 'a') if args.output else sys.stdout
+    try:
+        for case in cases(args):
+            process = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.run', '--case', json.dumps(case)],
+                stdout=subprocess.PIPE, universal_newlines=True, check=True)
+            result = json.loads(process.stdout.strip().splitlines()[-1])
+            out.write(json.dumps(result, sort_keys=True) + '\n')
+            out.flush()
+            print('{workload} records={records} lazy={lazy} verbose={verbose}: '
+                  '{seconds:.3f}s, {throughput:.0f} records/s'.format(**result), file=sys.stderr)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+# Serializers on the intermediate records of the workloads
+# the records are the outputs of the map and reduce steps, collected by a trace
+# run: python -m benchmarks.serialization [records]
+import sys
+import time
+
+from mapreduce import RingBufferTrace, Serializer
+from benchmarks.workloads import WORKLOADS
+
+
+SERIALIZERS = {
+    'pickle': Serializer(),
+    'marshal': Serializer('marshal'),
+    'pickle+zlib': Serializer(compression='zlib'),
+}
+
+
+def workload_records(name, records):
+    trace = RingBufferTrace(maxlen=records)
+    run = WORKLOADS[name](records, 'zipf', {'verbose': trace})
+    run()
+    return [event[2] for event in trace.events if event[0] is not None]
+
+
+def measure(serializer, records, chunksize=1000, repeat=3):
+    chunks = [records[i:i + chunksize] for i in range(0, len(records), chunksize)]
+    best_dumps = best_loads = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        encoded = [serializer.dumps(chunk) for chunk in chunks]
+        best_dumps = min(best_dumps, time.perf_counter() - start)
+        start = time.perf_counter()
+        for data in encoded:
+            serializer.loads(data)
+        best_loads = min(best_loads, time.perf_counter() - start)
+    return best_dumps, best_loads, sum(len(data) for data in encoded)
+
+
+def run(records):
+    print('records={}'.format(records))
+    for name in WORKLOADS:
+        x = workload_records(name, records)
+        print('{} ({} records, e.g. {!r})'.format(name, len(x), x[0]))
+        for serializer_name, serializer in SERIALIZERS.items():
+            dumps, loads, size = measure(serializer, x)
+            print('  {:13} dumps {:6.0f} ns/record, loads {:6.0f} ns/record, {:5.1f} bytes/record'.format(
+                serializer_name + ':', dumps / len(x) * 1e9, loads / len(x) * 1e9, size / len(x)))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10 ** 5)
@@ -0,0 +1,219 @@
+# The workloads of tests/test_examples.py, parametrized by input size
+# every workload takes the number of input records, the key distribution and the task options
+# and returns a function which runs the job and returns (output records, tasks)
+import functools
+import itertools
+
+from mapreduce import MapReduceTask
+from benchmarks import generators
+
+
+def word_count(n, distribution, options):
+    lines = generators.text_lines(n, distribution=distribution)
+
+    t = MapReduceTask(**options)
+
+    @t.map
+    def m1(k, v):
+        for word in v.split(' '):
+            yield word, 1
+
+    @t.reduce
+    def r1(k, v):
+        yield k, sum(v)
+
+    def run():
+        return list(t(lines)), [t]
+    return run
+
+
+def page_rank(n, distribution, options, iterations=3, alpha=0.5):
+    graph = generators.random_graph(n, distribution=distribution)
+    N = len(graph)
+
+    t = MapReduceTask(**options)
+
+    @t.map
+    def m0(k, v):
+        url, outgoing = v
+        yield url, (1 / N, list(outgoing))
+
+    with t.repeated(iterations) as repeated:
+        @repeated.reduce
+        def r1(url, values):
+            rank = 0
+            l = []
+            for v in values:
+                rank += v[0] * (1 - alpha)
+                l += v[1]
+            yield url, (rank, l)
+
+        @repeated.map
+        def m1(url, value):
+            yield url, (alpha / N, value[1])
+            for t in value[1]:
+                yield t, (value[0] / len(value[1]), [])
+
+    @t.reduce
+    def r_final(url, values):
+        yield url, sum(v[0] for v in values)
+
+    def run():
+        return list(t(graph.items())), [t]
+    return run
+
+
+def join(n, distribution, options):
+    s, r = generators.relations(n, max(1, n // 2), distribution)
+
+    st = MapReduceTask(**options)
+
+    @st.map
+    def map_s(k, v):
+        yield v[0], (v[1], 's')
+
+    rt = MapReduceTask(**options)
+
+    @rt.map
+    def map_r(k, v):
+        yield v[0], (v[1], 'r')
+
+    t = MapReduceTask(**options)
+
+    @t.map
+    def map_all(k, v):
+        yield v[0], v[1]
+
+    @t.reduce
+    def reduce_all(key, values):
+        left = [v[0] for v in values if v[1] == 's']
+        right = [v[0] for v in values if v[1] == 'r']
+        for t1 in right:
+            for t2 in left:
+                yield key, (t1, t2)
+
+    def run():
+        return list(t(itertools.chain(st(s), rt(r)))), [st, rt, t]
+    return run
+
+
+def bfs(n, distribution, options):
+    graph = generators.random_graph(n, distribution=distribution)
+    start_node = 'n0'
+
+    t = MapReduceTask(**options)
+
+    @t.map
+    def m1(k, v):
+        node, neighbors = v
+        yield node, (1 if node == start_node else 0, neighbors)
+
+    with t.repeated() as repeated:
+        @repeated.reduce
+        def r1(node, l):
+            state = 0
+            neighbors = []
+            for i in l:
+                state = max(state, i[0])
+                neighbors += i[1]
+            if state == 1:
+                for o in neighbors:
+                    yield o, (1, [])
+                state = 2
+            yield node, (state, neighbors)
+
+        with repeated.discarded(verbose=options.get('verbose', True)) as discarded:
+            @discarded.map
+            def m2_break(k, v):
+                yield 'all', v[0]
+
+            @discarded.reduce
+            def break_reduce(k, v):
+                if 1 not in v:
+                    repeated.stop()
+                if False:
+                    yield
+
+    def run():
+        return list(t(graph.items())), [t]
+    return run
+
+
+def k_means(n, distribution, options, k=3, iterations=3):
+    d = generators.points(n)
+    c = [d[0], d[1], d[2]]
+
+    t = MapReduceTask(**options)
+
+    @t.map
+    def m1(key, point):
+        best = min(range(k), key=lambda i: abs(point - c[i]))
+        yield best, point
+
+    @t.reduce
+    def r1(i, l):
+        yield 0, (i, sum(l) / len(l))
+
+    @t.reduce
+    def r2(key, l):
+        yield 0, [i[1] for i in sorted(l)]
+
+    def run():
+        nonlocal c
+        for _ in range(iterations):
+            c = list(t(d))[0][1]
+            c += c[-1:] * (k - len(c))  # empty clusters
+        return c, [t]
+    return run
+
+
+def matrix_product(n, distribution, options, m=10, p=4):
+    # a (rows x m) * b (m x p), both sides emit about n/2 records into the shuffle
+    rows = max(1, n // (2 * m * p))
+    la = generators.sparse_matrix(rows, m, rows * m)
+    lb = generators.sparse_matrix(m, p, m * p, seed=1)
+
+    ta = MapReduceTask(**options)
+
+    @ta.map
+    def map_a(k, v):
+        in_row, in_col, value = v
+        for out_col in range(1, p + 1):
+            yield (in_row, out_col, in_col), value
+
+    tb = MapReduceTask(**options)
+
+    @tb.map
+    def map_b(k, v):
+        in_row, in_col, value = v
+        for out_row in range(1, rows + 1):
+            yield (out_row, in_col, in_row), value
+
+    t = MapReduceTask(**options)
+
+    @t.map
+    def m0_all(k, v):
+        yield v[0], v[1]
+
+    @t.reduce
+    def reduce_mult(k, values):
+        out_row, out_col, idx = k
+        yield (out_row, out_col), functools.reduce(lambda a, b: a * b, values)
+
+    @t.reduce
+    def reduce_sum(k, values):
+        yield k, sum(values)
+
+    def run():
+        return list(t(itertools.chain(ta(la), tb(lb)))), [ta, tb, t]
+    return run
+
+
+WORKLOADS = {
+    'word_count': word_count,
+    'page_rank': page_rank,
+    'join': join,
+    'bfs': bfs,
+    'k_means': k_means,
+    'matrix_product': matrix_product,
+}
@@ -1 +1,10 @@
 from mapreduce.mapreduce import MapReduceTask
+from mapreduce.mapreduce import Aggregator, Sum, Count, Min, Max, Mean, Multi
+from mapreduce.mapreduce import Trace, PrintTrace, RingBufferTrace, FileTrace
+from mapreduce.mapreduce import Broadcast
+from mapreduce.mapreduce import StageCache
+from mapreduce.mapreduce import FileSource, TextSource, JsonLinesSource, CsvSource, BinarySource
+from mapreduce.mapreduce import Sink, JsonLinesSink, CsvSink, BinarySink, read_records
+from mapreduce.mapreduce import Serializer
+from mapreduce.mapreduce import StateStore
+from mapreduce.mapreduce import Columns
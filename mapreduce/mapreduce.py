@@ -2,9 +2,41 @@
 # Copyright (c) 2021 Aleksandr Zuev
 # See LICENSE for further information
 
-from collections import defaultdict
-from functools import reduce
+import asyncio
+import bisect
+from collections import Counter, defaultdict, deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+import csv
+from functools import partial, reduce
 import itertools
+import bz2
+import hashlib
+import heapq
+import inspect
+import multiprocessing
+from operator import itemgetter
+import os
+import json
+import lzma
+import marshal
+import mmap
+import pickle
+import queue
+import random
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import traceback
+import types
+import zlib
+
+try:
+    import numpy as np
+except ImportError:  # only batch steps need it
+    np = None
 
 def mapdict():
     return defaultdict(list)
@@ -22,73 +54,1921 @@ def flat_map(function, iterable):
         for i in map_iterable:
             yield i
 
+def _fused_loops(functions):
+    # nested loops compiled for the functions, so there is one generator per record
+    # instead of one per record and function
+    lines = ['def fused(k0, v0):']
+    for i in range(len(functions)):
+        lines.append('    ' * (i + 1) + 'for k{1}, v{1} in f{0}(k{0}, v{0}):'.format(i, i + 1))
+    lines.append('    ' * (len(functions) + 1) + 'yield k{0}, v{0}'.format(len(functions)))
+    namespace = {'f{}'.format(i): function for i, function in enumerate(functions)}
+    exec('\n'.join(lines), namespace)
+    return namespace['fused']
+
+class Fused:
+    # single map function which runs a record through all the functions, it can be pickled
+    # (sent to an executor) when they can, the loops are compiled in every process
+    def __init__(self, functions):
+        self.functions = functions
+        self.__name__ = '+'.join(function.__name__ for function in functions)
+        self._loops = None
+
+    @property
+    def loops(self):
+        if self._loops is None:
+            self._loops = _fused_loops(self.functions)
+        return self._loops
+
+    def __call__(self, k, v):
+        return self.loops(k, v)
+
+    def __getstate__(self):
+        return dict(self.__dict__, _loops=None)
+
+def compose(*functions):
+    return Fused(functions)
+
+def is_async(function):
+    return inspect.iscoroutinefunction(function) or inspect.isasyncgenfunction(function)
+
+async def _call_async(function, i):
+    # async generators yield the records, coroutines return an iterable of them
+    if inspect.isasyncgenfunction(function):
+        result = []
+        async for j in function(i[0], i[1]):
+            result.append(j)
+        return result
+    result = await function(i[0], i[1])
+    return [] if result is None else list(result)
+
+def async_map(function, iterable, concurrency=100, ordered=True):
+    # runs up to `concurrency` calls at once on an event loop,
+    # yields (input, output list) pairs in input order or as soon as they are done
+    loop = asyncio.new_event_loop()
+    helper = None
+    run = loop.run_until_complete
+    if asyncio._get_running_loop() is not None:  # get_running_loop is 3.7+
+        # called from a coroutine, a second loop can't run in this thread
+        helper = ThreadPoolExecutor(1)
+        run = lambda awaitable: helper.submit(loop.run_until_complete, awaitable).result()
+    pending = {}  # task -> input, in input order
+
+    def wait():
+        if ordered:
+            done = [next(iter(pending))]
+            run(done[0])
+        else:
+            done, _ = run(asyncio.wait(list(pending), return_when=asyncio.FIRST_COMPLETED))
+        return [(pending.pop(task), task.result()) for task in done]
+
+    try:
+        for i in iterable:
+            pending[loop.create_task(_call_async(function, i))] = i
+            if len(pending) >= concurrency:
+                for result in wait():
+                    yield result
+        while pending:
+            for result in wait():
+                yield result
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            run(asyncio.gather(*pending, return_exceptions=True))
+        loop.close()
+        if helper is not None:
+            helper.shutdown()
+
+def lazy_call(function):
+    yield function()
+
 def items_of_single(x):
     for i in next(x).items():
         yield i
 
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+def mp_context():
+    # with fork the workers inherit step functions, which are usually
+    # closures (nonlocal, decorators inside functions) and can't be pickled
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+_worker_function = None
+
+def _init_worker(function):
+    global _worker_function
+    _worker_function = function
+
+def _map_chunk(chunk, function=None, traced=True):
+    # (input, output list) pairs when traced, otherwise only the outputs,
+    # so the inputs aren't sent back from the workers
+    if function is None:
+        function = _worker_function
+    if traced:
+        return [(i, list(function(i[0], i[1]))) for i in chunk]
+    return [record for i in chunk for record in function(i[0], i[1])]
+
+def _map_splits(chunk, function=None, traced=True):
+    # the records of (source, start, end) splits are read by the worker itself
+    results = []
+    for source, start, end in chunk:
+        results.extend(_map_chunk(source.read(start, end), function, traced))
+    return results
+
+def group_items(items, agg=None):
+    if agg is None:
+        groups = mapdict()
+        for k, v in items:
+            groups[k].append(v)
+        return groups.items()
+    # only one running accumulator per key
+    accumulators = {}
+    for k, v in items:
+        acc = accumulators.get(k, _initial_missing)
+        if acc is _initial_missing:
+            acc = agg.create()
+        accumulators[k] = agg.add(acc, v)
+    return [(k, agg.result(acc)) for k, acc in accumulators.items()]
+
+def _aggregate_chunk(chunk, agg=None):
+    # partial accumulators of a single chunk, merged afterwards
+    if agg is None:
+        agg = _worker_function
+    accumulators = {}
+    for k, v in chunk:
+        acc = accumulators.get(k, _initial_missing)
+        if acc is _initial_missing:
+            acc = agg.create()
+        accumulators[k] = agg.add(acc, v)
+    return list(accumulators.items())
+
+def merge_partials(agg, partials):
+    accumulators = {}
+    for k, acc in partials:
+        if k in accumulators:
+            acc = agg.merge(accumulators[k], acc)
+        accumulators[k] = acc
+    for k, acc in accumulators.items():
+        yield k, agg.result(acc)
+
+def _combine_chunk(chunk, function=None, traced=True):
+    # local reduce of a single chunk, the output is reduced again later
+    return _map_chunk(list(group_items(chunk)), function, traced)
+
+_compressors = {
+    None: (lambda data: data, lambda data: data),
+    'zlib': (partial(zlib.compress, level=1), zlib.decompress),
+    'bz2': (bz2.compress, bz2.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+
+class Serializer:
+    # encodes lists of records for everything that leaves the process: spilled runs, checkpoints,
+    # cached step outputs, binary sinks and chunks sent to workers
+    # the default codec is pickle with a fixed protocol, marshal is faster to write for tuples of
+    # strings and ints but larger, and its format can change between Python versions, so it is
+    # only used for data read by the same process tree, and `persistent` is pickled
+    # unsupported types fall back to pickle, the codec is in the first byte
+    # write/read_frames frame the encoded data with its length
+    _frame = struct.Struct('<Q')
+    protocol = 4  # readable from Python 3.4
+
+    def __init__(self, codec='pickle', compression=None):
+        if codec not in ('marshal', 'pickle'):
+            raise ValueError('unknown codec {!r}'.format(codec))
+        self.codec = codec
+        if compression not in _compressors:
+            raise ValueError('unknown compression {!r}'.format(compression))
+        self.compression = compression  # looked up by name, the serializer is sent to workers
+
+    @property
+    def persistent(self):
+        # for data stored on disk beyond the run
+        return self if self.codec == 'pickle' else Serializer('pickle', self.compression)
+
+    def dumps(self, records):
+        compress = _compressors[self.compression][0]
+        if self.codec == 'marshal':
+            try:
+                return compress(b'm' + marshal.dumps(records))
+            except ValueError:  # unmarshallable object
+                pass
+        return compress(b'p' + pickle.dumps(records, self.protocol))
+
+    def loads(self, data):
+        data = _compressors[self.compression][1](data)
+        if data[:1] == b'm':
+            return marshal.loads(data[1:])
+        return pickle.loads(data[1:])
+
+    def write_frame(self, f, records):
+        data = self.dumps(records)
+        f.write(self._frame.pack(len(data)))
+        f.write(data)
+
+    def read_frames(self, f):
+        while True:
+            header = f.read(self._frame.size)
+            if not header:
+                return
+            yield self.loads(f.read(self._frame.unpack(header)[0]))
+
+    def __repr__(self):
+        return 'Serializer({!r}, compression={!r})'.format(self.codec, self.compression)
+
+default_serializer = Serializer()
+
+def _encoded_chunk(data, chunk_func, serializer):
+    # worker side of a chunk sent as bytes
+    return serializer.dumps(chunk_func(serializer.loads(data)))
+
+def write_run(records, directory=None, batch_size=1000, serializer=default_serializer,
+              key=itemgetter(0), reverse=False):
+    # sorted run of (hash, key, value) records, equal keys are adjacent
+    records.sort(key=key, reverse=reverse)
+    f = tempfile.TemporaryFile(dir=directory)
+    for batch in chunked(records, batch_size):
+        serializer.write_frame(f, batch)
+    f.seek(0)
+    return f
+
+def read_run(f, serializer=default_serializer):
+    for batch in serializer.read_frames(f):
+        for record in batch:
+            yield record
+
+class _SpilledRuns:
+    # sorted runs on disk: every `fan_in` runs of a level are merged into one run of the next
+    # level, so the open files and read batches grow with the log of the input size,
+    # equal records keep the order in which they were added
+    def __init__(self, directory=None, serializer=default_serializer, key=itemgetter(0),
+                 reverse=False, fan_in=64):
+        self.directory = directory
+        self.serializer = serializer
+        self.key = key
+        self.reverse = reverse
+        self.fan_in = fan_in
+        self.levels = []  # the runs of each level, oldest first
+
+    def __len__(self):
+        return sum(len(runs) for runs in self.levels)
+
+    def add(self, records):
+        self._add(0, write_run(records, self.directory, serializer=self.serializer,
+                               key=self.key, reverse=self.reverse))
+
+    def _add(self, level, f):
+        if level == len(self.levels):
+            self.levels.append([])
+        runs = self.levels[level]
+        runs.append(f)
+        if len(runs) >= self.fan_in:
+            self.levels[level] = []
+            self._add(level + 1, self._merge(runs))
+
+    def _merge(self, runs):
+        try:
+            f = tempfile.TemporaryFile(dir=self.directory)
+            for batch in chunked(self.merged(runs=runs), 1000):
+                self.serializer.write_frame(f, batch)
+            f.seek(0)
+            return f
+        finally:
+            for run in runs:
+                run.close()
+
+    def merged(self, *buffers, runs=None):
+        # the records of the runs and the sorted buffers, which come after the runs
+        if runs is None:
+            runs = [f for level in reversed(self.levels) for f in level]  # older levels first
+            self.levels = [runs]
+            while len(runs) > self.fan_in:
+                runs[:self.fan_in] = [self._merge(runs[:self.fan_in])]
+        return heapq.merge(*[read_run(f, self.serializer) for f in runs], *buffers,
+                           key=self.key, reverse=self.reverse)
+
+    def close(self):
+        for runs in self.levels:
+            for f in runs:
+                f.close()
+        self.levels = []
+
+def external_group(items, threshold, directory=None, serializer=default_serializer, fan_in=64):
+    # group items like mapdict, but keep at most `threshold` records in memory,
+    # the rest is spilled to sorted runs on disk which are merged afterwards
+    # records are tagged with the id of their key, so the keys come in the order of their
+    # first records, like in memory
+    ids = {}
+    keys = []
+    runs = _SpilledRuns(directory, serializer, fan_in=fan_in)
+    buffer = []
+    try:
+        for k, v in items:
+            i = ids.get(k)
+            if i is None:
+                i = ids[k] = len(keys)
+                keys.append(k)
+            buffer.append((i, v))
+            if len(buffer) >= threshold:
+                runs.add(buffer)
+                buffer = []
+        if not runs:
+            # everything fits in memory
+            for i in group_items((keys[i], v) for i, v in buffer):
+                yield i
+            return
+        buffer.sort(key=itemgetter(0))
+        for i, records in itertools.groupby(runs.merged(buffer), key=itemgetter(0)):
+            yield keys[i], [v for _, v in records]
+    finally:
+        runs.close()
+
+_join_types = ('inner', 'left', 'right', 'outer')
+
+def sorted_group(items, sort_key, reverse=False, threshold=None, directory=None,
+                 serializer=default_serializer, materialize=False, fan_in=64):
+    # secondary sort: groups in the order of their first records like mapdict, with values
+    # sorted by sort_key, the records are sorted once by (key id, sort key) and the values
+    # of a key are an iterator, so a reducer can stop reading early
+    # over the threshold, records are sorted in runs on disk which are merged
+    ids = {}
+    keys = []
+    sign = -1 if reverse else 1  # the keys stay in order when sorted in reverse
+    order = itemgetter(0, 1)
+    runs = _SpilledRuns(directory, serializer, key=order, reverse=reverse, fan_in=fan_in)
+    try:
+        buffer = []
+        for k, v in items:
+            i = ids.get(k)
+            if i is None:
+                i = ids[k] = len(keys)
+                keys.append(k)
+            buffer.append((sign * i, sort_key(v), v))
+            if threshold is not None and len(buffer) >= threshold:
+                runs.add(buffer)
+                buffer = []
+        buffer.sort(key=order, reverse=reverse)
+        for i, records in itertools.groupby(runs.merged(buffer), key=itemgetter(0)):
+            values = map(itemgetter(2), records)
+            yield keys[sign * i], list(values) if materialize else values
+    finally:
+        runs.close()
+
+def salted_group(items, function, threshold, group=None):
+    # for an associative reducer (its outputs for a key can be reduced again with other values):
+    # after `threshold` values of a key, its next values are split into salted sub-partitions of
+    # `threshold` values which are reduced on their own, and only their partial results go to
+    # the group, so a hot key never has more than about count / threshold + 2 * threshold values
+    counts = Counter()
+    salted = mapdict()
+
+    def partials(k, values):
+        for _, v in function(k, values):
+            yield k, v
+
+    def records():
+        for k, v in items:
+            counts[k] += 1
+            if counts[k] <= threshold:
+                yield k, v
+                continue
+            values = salted[k]
+            values.append(v)
+            if len(values) >= threshold:
+                del salted[k]
+                yield from partials(k, values)
+        for k, values in salted.items():
+            yield from partials(k, values)
+
+    return (group or group_items)(records())
+
+def hash_join(left, right, how='inner'):
+    # the right side is indexed in memory, the left one is streamed
+    # records (key, (left value, right value)), None for the missing side of outer joins
+    table = mapdict()
+    for k, v in right:
+        table[k].append(v)
+    matched = set()
+    for k, v in left:
+        values = table.get(k)
+        if values is None:
+            if how in ('left', 'outer'):
+                yield k, (v, None)
+            continue
+        if how in ('right', 'outer'):
+            matched.add(k)
+        for w in values:
+            yield k, (v, w)
+    if how in ('right', 'outer'):
+        for k, values in table.items():
+            if k not in matched:
+                for w in values:
+                    yield k, (None, w)
+
+def _sorted_runs(records, side, threshold, runs):
+    # (hash, side, key, value) records sorted by hash, spilled to runs over the threshold
+    buffer = []
+    for k, v in records:
+        buffer.append((hash(k), side, k, v))
+        if threshold is not None and len(buffer) >= threshold:
+            runs.add(buffer)
+            buffer = []
+    buffer.sort(key=itemgetter(0, 1))
+    return buffer
+
+def sort_merge_join(left, right, how='inner', threshold=None, directory=None, serializer=default_serializer,
+                    fan_in=64):
+    # both sides are sorted by key hash (on disk over the threshold) and merged,
+    # the left records of a key come first and only they are held in memory,
+    # the right ones are streamed, so a hot key costs as much as its output
+    runs = _SpilledRuns(directory, serializer, key=itemgetter(0, 1), fan_in=fan_in)
+    try:
+        buffers = [_sorted_runs(left, 0, threshold, runs),
+                   _sorted_runs(right, 1, threshold, runs)]
+        for h, records in itertools.groupby(runs.merged(*buffers), key=itemgetter(0)):
+            group = mapdict()  # there can be several keys with the same hash
+            matched = set()
+            for _, side, k, v in records:
+                if side == 0:
+                    group[k].append(v)
+                    continue
+                values = group.get(k)
+                if values is None:
+                    if how in ('right', 'outer'):
+                        yield k, (None, v)
+                    continue
+                matched.add(k)
+                for w in values:
+                    yield k, (w, v)
+            if how in ('left', 'outer'):
+                for k, values in group.items():
+                    if k not in matched:
+                        for w in values:
+                            yield k, (w, None)
+    finally:
+        runs.close()
+
+def save_checkpoint(directory, iteration, state, keep=2, serializer=default_serializer):
+    # the state of a repeated block after `iteration` iterations, the file is replaced atomically
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'checkpoint-{:08d}'.format(iteration))
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+        f.write(serializer.persistent.dumps(state))
+    os.replace(f.name, path)
+    for old in checkpoints(directory)[:-keep]:
+        os.remove(old)
+
+def checkpoints(directory):
+    if not os.path.isdir(directory):
+        return []
+    names = sorted(n for n in os.listdir(directory) if n.startswith('checkpoint-'))
+    return [os.path.join(directory, n) for n in names]
+
+def load_checkpoint(directory, serializer=default_serializer):
+    # the state of the latest checkpoint, None if there is none
+    paths = checkpoints(directory)
+    if not paths:
+        return None
+    with open(paths[-1], 'rb') as f:
+        return serializer.persistent.loads(f.read())
+
+def _hash_code(code, h):
+    h.update(code.co_code)
+    h.update(repr((code.co_names, code.co_varnames, code.co_freevars)).encode())
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _hash_code(const, h)
+        else:
+            h.update(repr(const).encode())
+
+class _Undigestible(Exception):
+    # a step uses a value that can't be fingerprinted by its content, its output isn't cached
+    pass
+
+def _global_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _global_names(const)
+    return names
+
+def _hash_value(value, h, seen):
+    # a value used by a step function, by its content
+    if isinstance(value, types.FunctionType):
+        _hash_function(value, h, seen)
+    elif isinstance(value, types.ModuleType):
+        h.update(value.__name__.encode())
+    elif isinstance(value, (MapReduceSteps, Broadcast)):
+        # blocks and broadcasts are fingerprinted as steps
+        h.update(type(value).__name__.encode())
+    else:
+        try:
+            h.update(pickle.dumps(value, 4))
+        except Exception as e:
+            raise _Undigestible('{!r} can\'t be fingerprinted: {}'.format(type(value).__name__, e))
+
+def _hash_function(function, h, seen=None):
+    # the code and the constants of the function, and the values it uses from enclosing
+    # functions (nonlocal) and from its module (globals)
+    seen = set() if seen is None else seen
+    for f in getattr(function, 'functions', [function]):  # fused map steps
+        code = getattr(f, '__code__', None)
+        if code is None:
+            _hash_value(f, h, seen)
+            continue
+        if f in seen:  # recursion
+            h.update(f.__qualname__.encode())
+            continue
+        seen.add(f)
+        _hash_code(code, h)
+        for value in f.__defaults__ or ():
+            _hash_value(value, h, seen)
+        for name, value in sorted((f.__kwdefaults__ or {}).items()):
+            h.update(name.encode())
+            _hash_value(value, h, seen)
+        for cell in f.__closure__ or ():
+            try:
+                value = cell.cell_contents
+            except ValueError:  # not assigned yet
+                continue
+            _hash_value(value, h, seen)
+        for name in sorted(_global_names(code)):
+            if name in f.__globals__:  # not attributes or builtins
+                h.update(name.encode())
+                _hash_value(f.__globals__[name], h, seen)
+
+def step_fingerprint(step):
+    h = hashlib.sha256()
+    kind = getattr(step, 'kind', None)
+    h.update(repr(kind).encode())
+    if isinstance(step, MapReduceSteps):
+        # repeated and discarded blocks
+        h.update(repr(getattr(step, 'times', None)).encode())
+        for s in step._plan():
+            h.update(step_fingerprint(s).encode())
+    else:
+        _hash_function(step.function, h)
+        h.update(repr(getattr(step, 'agg', None)).encode())
+        for option in getattr(step, 'options', ()):
+            if isinstance(option, types.FunctionType):
+                _hash_function(option, h)  # the key of top, its repr has an address
+            else:
+                h.update(repr(option).encode())
+    return h.hexdigest()
+
+def records_digest(records, batch_size=1000):
+    h = hashlib.sha256()
+    for batch in chunked(records, batch_size):
+        # not marshal, its output depends on reference counts
+        h.update(pickle.dumps(batch, pickle.HIGHEST_PROTOCOL))
+    return h.hexdigest()
+
+class StageCache:
+    # on-disk cache of the outputs of task steps, an entry is addressed by the digest of the input
+    # and the fingerprints of all the steps up to it, so it is reused until something upstream changes
+    # least recently used entries are removed when the total size is above max_bytes
+    def __init__(self, directory, max_bytes=2 ** 30, serializer=default_serializer):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.serializer = serializer.persistent
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.records')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                records = self.serializer.loads(f.read())
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return None
+        os.utime(path)  # used recently
+        return records
+
+    def put(self, key, records):
+        with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as f:
+            f.write(self.serializer.dumps(records))
+        os.replace(f.name, self._path(key))
+        self._evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.records'):
+                st = os.stat(os.path.join(self.directory, name))
+                entries.append((st.st_mtime, st.st_size, name[:-len('.records')]))
+        return sorted(entries)
+
+    def _evict(self):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            self.invalidate(key)
+            total -= size
+
+    def invalidate(self, key=None):
+        # removes one entry, or all of them
+        keys = [key] if key is not None else [key for _, _, key in self._entries()]
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        self.invalidate()
+
+class FileSource:
+    # records of a file keyed by their byte offsets, the file is split into byte ranges
+    # and a split has the records which start in it, so every split can be read on its own
+    def __init__(self, path, split_size=32 * 2 ** 20):
+        self.path = path
+        self.split_size = split_size
+
+    def splits(self):
+        size = os.path.getsize(self.path)
+        return [(start, min(start + self.split_size, size)) for start in range(0, size, self.split_size)]
+
+    def read(self, start=0, end=None):
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return  # can't mmap an empty file
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                yield from self._records(m, start, len(m) if end is None else end)
+
+    def _records(self, m, start, end):
+        raise NotImplementedError
+
+    def __iter__(self):
+        return self.read()
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.path)
+
+class TextSource(FileSource):
+    # lines without the line ends, like Hadoop's TextInputFormat
+    def __init__(self, path, split_size=32 * 2 ** 20, encoding='utf-8'):
+        super().__init__(path, split_size)
+        self.encoding = encoding
+
+    def _lines(self, m, start, end):
+        pos = start
+        if start > 0:
+            # the line started in the previous split belongs to it
+            pos = m.find(b'\n', start - 1) + 1
+            if pos == 0:
+                return
+        size = len(m)
+        while pos < end:
+            line_end = m.find(b'\n', pos)
+            if line_end < 0:
+                line_end = size
+            line = m[pos:line_end]
+            if line.endswith(b'\r'):
+                line = line[:-1]
+            yield pos, line
+            pos = line_end + 1
+
+    def _records(self, m, start, end):
+        for pos, line in self._lines(m, start, end):
+            yield pos, line.decode(self.encoding)
+
+class JsonLinesSource(TextSource):
+    def _records(self, m, start, end):
+        for pos, line in self._lines(m, start, end):
+            if line.strip():
+                yield pos, json.loads(line.decode(self.encoding))
+
+class CsvSource(TextSource):
+    # rows as lists, or dicts with header=True, quoted fields can't contain line ends
+    def __init__(self, path, split_size=32 * 2 ** 20, encoding='utf-8', header=False, **fmtparams):
+        super().__init__(path, split_size, encoding)
+        self.header = header
+        self.fmtparams = fmtparams
+
+    def _row(self, line):
+        return next(csv.reader([line.decode(self.encoding)], **self.fmtparams))
+
+    def _records(self, m, start, end):
+        names = None
+        if self.header:
+            names = self._row(next(self._lines(m, 0, 1))[1])
+            start = max(start, 1)  # skips the header line
+        for pos, line in self._lines(m, start, end):
+            if not line:
+                continue
+            row = self._row(line)
+            yield pos, row if names is None else dict(zip(names, row))
+
+class BinarySource(FileSource):
+    # fixed width records, bytes or tuples unpacked by a struct format
+    def __init__(self, path, record_size=None, format=None, split_size=32 * 2 ** 20):
+        if format is not None:
+            record_size = struct.calcsize(format)
+        split_size = max(split_size // record_size, 1) * record_size
+        super().__init__(path, split_size)
+        self.record_size = record_size
+        self.format = format
+
+    def _records(self, m, start, end):
+        size = self.record_size
+        unpack = struct.Struct(self.format).unpack_from if self.format is not None else None
+        # a trailing incomplete record is ignored
+        end = min(end, len(m) - len(m) % size)
+        for pos in range(start, end, size):
+            yield pos, unpack(m, pos) if unpack is not None else m[pos:pos + size]
+
+def stable_hash(key):
+    # unlike hash(), the same in every process and run
+    return zlib.crc32(repr(key).encode())
+
+class Sink:
+    # writes the output records (key, value) to the files part-00000.. in a directory, one file
+    # or `partitions` files split by key hash, or by key ranges with sorted `boundaries`
+    # (the keys below boundaries[0] go to the first file, and so on)
+    extension = ''
+    binary = False
+
+    def __init__(self, directory, partitions=1, boundaries=None, buffer_size=2 ** 20):
+        self.directory = directory
+        self.boundaries = sorted(boundaries) if boundaries is not None else None
+        self.partitions = len(self.boundaries) + 1 if boundaries is not None else partitions
+        self.buffer_size = buffer_size
+
+    def paths(self):
+        return [os.path.join(self.directory, 'part-{:05d}{}'.format(p, self.extension))
+                for p in range(self.partitions)]
+
+    def partition(self, key):
+        if self.boundaries is not None:
+            return bisect.bisect_right(self.boundaries, key)
+        return stable_hash(key) % self.partitions
+
+    def write(self, records):
+        os.makedirs(self.directory, exist_ok=True)
+        paths = self.paths()
+        files = []
+        try:
+            for path in paths:
+                if self.binary:
+                    files.append(open(path, 'wb', buffering=self.buffer_size))
+                else:
+                    files.append(open(path, 'w', buffering=self.buffer_size, newline='', encoding='utf-8'))
+            writers = [self._writer(f) for f in files]
+            for record in records:
+                writers[self.partition(record[0]) if self.partitions > 1 else 0](record)
+            for writer in writers:
+                if hasattr(writer, 'flush'):
+                    writer.flush()
+        finally:
+            for f in files:
+                f.close()
+        return paths
+
+    def _writer(self, f):
+        raise NotImplementedError
+
+class JsonLinesSink(Sink):
+    # a [key, value] array per line
+    extension = '.jsonl'
+
+    def _writer(self, f):
+        dumps = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+        return lambda record: f.write(dumps(record) + '\n')
+
+class CsvSink(Sink):
+    # key and value in a row, tuple and list values in several columns
+    extension = '.csv'
+
+    def __init__(self, directory, partitions=1, boundaries=None, buffer_size=2 ** 20, **fmtparams):
+        super().__init__(directory, partitions, boundaries, buffer_size)
+        self.fmtparams = fmtparams
+
+    def _writer(self, f):
+        writerow = csv.writer(f, **self.fmtparams).writerow
+
+        def write(record):
+            k, v = record
+            writerow([k] + list(v) if isinstance(v, (tuple, list)) else [k, v])
+        return write
+
+class BinarySink(Sink):
+    # frames of serialized records, read back by read_records
+    extension = '.bin'
+    binary = True
+
+    def __init__(self, directory, partitions=1, boundaries=None, buffer_size=2 ** 20,
+                 serializer=default_serializer, batch_size=1000):
+        super().__init__(directory, partitions, boundaries, buffer_size)
+        self.serializer = serializer.persistent
+        self.batch_size = batch_size
+
+    def _writer(self, f):
+        batch = []
+
+        def write(record):
+            batch.append(record)
+            if len(batch) >= self.batch_size:
+                flush()
+
+        def flush():
+            if batch:
+                self.serializer.write_frame(f, batch)
+                batch.clear()
+
+        write.flush = flush
+        return write
+
+def read_records(path, serializer=default_serializer):
+    # records of a BinarySink file
+    with open(path, 'rb') as f:
+        for batch in serializer.persistent.read_frames(f):
+            yield from batch
+
+class StateStore:
+    # per-key reduce state of incremental runs, in a sqlite database, so a run reads and
+    # writes only the states of its keys, which are stored by their repr (it has to be stable:
+    # strings, numbers, tuples of them)
+    def __init__(self, path, serializer=default_serializer, batch_size=500):
+        self.path = path
+        self.serializer = serializer.persistent
+        self.batch_size = batch_size
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value BLOB)')
+
+    def get_many(self, keys):
+        states = {}
+        for batch in chunked(keys, self.batch_size):
+            rows = self._db.execute('SELECT value FROM state WHERE key IN ({})'.format(','.join('?' * len(batch))),
+                                    [repr(k) for k in batch])
+            for value, in rows:
+                k, state = self.serializer.loads(value)
+                states[k] = state
+        return states
+
+    def put_many(self, items):
+        with self._db:  # a transaction
+            self._db.executemany('INSERT OR REPLACE INTO state VALUES (?, ?)',
+                                 ((repr(k), self.serializer.dumps([k, state])) for k, state in items))
+
+    def items(self):
+        for value, in self._db.execute('SELECT value FROM state'):
+            k, state = self.serializer.loads(value)
+            yield k, state
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM state').fetchone()[0]
+
+    def clear(self):
+        with self._db:
+            self._db.execute('DELETE FROM state')
+
+    def close(self):
+        self._db.close()
+
+def _require_numpy():
+    if np is None:
+        raise ImportError('batch steps need numpy')
+
+class Columns:
+    # columnar records of batch steps: (keys, values) pairs of NumPy arrays, tuple keys and values
+    # are rows of 2-d arrays, the other steps iterate over them as (key, value) records
+    def __init__(self, keys=None, values=None, batches=None):
+        if batches is None:
+            values = np.asarray(values)
+            keys = np.arange(len(values)) if keys is None else np.asarray(keys)
+            batches = [(keys, values)]
+        self.batches = batches
+
+    def __iter__(self):
+        for keys, values in self.batches:
+            keys = keys.tolist() if keys.ndim == 1 else map(tuple, keys.tolist())
+            values = values.tolist() if values.ndim == 1 else map(tuple, values.tolist())
+            yield from zip(keys, values)
+
+    def concatenated(self):
+        # all keys and all values
+        batches = list(self.batches)
+        if not batches:
+            return np.empty(0), np.empty(0)
+        if len(batches) == 1:
+            return batches[0]
+        return np.concatenate([k for k, _ in batches]), np.concatenate([v for _, v in batches])
+
+def to_batches(x, chunksize):
+    # (keys, values) arrays of chunks of records
+    if isinstance(x, Columns):
+        yield from x.batches
+        return
+    for chunk in chunked(x, chunksize):
+        keys, values = zip(*chunk)
+        yield np.asarray(keys), np.asarray(values)
+
+def group_columns(keys, values, stable=True):
+    # vectorized group by: keys and values sorted by key and the starts of the groups
+    # the values of a key keep their order with a stable sort, which is slower
+    if keys.ndim == 1:
+        order = np.argsort(keys, kind='stable' if stable else 'quicksort')
+    else:
+        order = np.lexsort(keys.T[::-1])  # tuple keys, by the first column, then the second...
+    keys = keys[order]
+    values = values[order]
+    changed = keys[1:] != keys[:-1]
+    if keys.ndim > 1:
+        changed = changed.any(axis=1)
+    starts = np.flatnonzero(np.concatenate(([len(keys) > 0], changed)))
+    return keys[starts], values, starts
+
+def _batch_count(values, starts):
+    return np.diff(np.append(starts, len(values)))
+
+def _batch_mean(values, starts):
+    counts = _batch_count(values, starts)
+    return np.add.reduceat(values, starts, axis=0) / (counts if values.ndim == 1 else counts[:, None])
+
+BATCH_AGGREGATORS = {
+    'sum': lambda values, starts: np.add.reduceat(values, starts, axis=0),
+    'count': _batch_count,
+    'min': lambda values, starts: np.minimum.reduceat(values, starts, axis=0),
+    'max': lambda values, starts: np.maximum.reduceat(values, starts, axis=0),
+    'mean': _batch_mean,
+}
+
+def picklable_error(e):
+    try:
+        pickle.dumps(e)
+        return e
+    except Exception:
+        return RuntimeError(''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+
+def _reduce_partition(function, group, index, inbox, outbox, keep_values, serializer=default_serializer,
+                      top=None):
+    # group the records of a single partition and run the reducer on every group
+    # every key is tagged with the position of its first record,
+    # so the output of all partitions can be merged in the order of a serial run
+    # with top=(n, key), only the n largest output records are kept, in a bounded heap
+    received = False
+    first = {}
+
+    def records():
+        nonlocal received
+        for data in iter(inbox.get, None):
+            for pos, (k, v) in serializer.loads(data):
+                if k not in first:
+                    first[k] = pos
+                yield k, v
+        received = True
+
+    try:
+        result = []
+        if top is not None:
+            n, key = top
+            heap = []
+            # records with equal keys are not compared, the earlier ones are kept like in nlargest:
+            # the ones of keys seen first, then the first ones of a key
+            counter = itertools.count()
+            for k, values in group(records()):
+                for record in function(k, values):
+                    item = (key(record), -first[k], -next(counter), k, record)
+                    if len(heap) < n:
+                        heapq.heappush(heap, item)
+                    else:
+                        heapq.heappushpop(heap, item)
+            result = [(-pos, k, None, [record]) for _, pos, _, k, record in heap]
+        else:
+            for k, values in group(records()):
+                output = list(function(k, values))
+                result.append((first[k], k, values if keep_values else None, output))
+        result.sort(key=itemgetter(0))  # in the order of the first records of all partitions
+        outbox.put((index, serializer.dumps(result)))
+    except BaseException as e:
+        if not received:
+            for _ in iter(inbox.get, None):  # don't block the sender
+                pass
+        outbox.put((index, picklable_error(e)))
+
+# threads have the same interface as processes of a multiprocessing context
+_threads = types.SimpleNamespace(Queue=queue.Queue, Event=threading.Event, Process=threading.Thread)
+
+class _Pipe:
+    # bounded queue of batches between two pipeline stages, `closed` is set when the reader stops,
+    # so the writer doesn't block forever, batches are serialized between processes
+    def __init__(self, context, size, serializer=None):
+        self.queue = context.Queue(size)
+        self.closed = context.Event()
+        self.serializer = serializer
+
+    def put(self, kind, payload=None):
+        while not self.closed.is_set():
+            try:
+                self.queue.put((kind, payload), timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def send(self, batch):
+        return self.put('data', self.serializer.dumps(batch) if self.serializer is not None else batch)
+
+    def records(self, processes=None):
+        # processes: the stages watched by the reader, which fail if one of them crashes
+        crashed = lambda process: process.exitcode not in (None, 0)
+        try:
+            while True:
+                if processes is None:
+                    kind, payload = self.queue.get()
+                else:
+                    kind, payload = while_alive(self.queue.get, processes, crashed)
+                if kind == 'end':
+                    return
+                if kind == 'error':
+                    raise payload
+                yield from self.serializer.loads(payload) if self.serializer is not None else payload
+        finally:
+            self.closed.set()
+
+def while_alive(operation, processes, dead=lambda process: not process.is_alive()):
+    # runs a blocking queue operation(timeout) until it succeeds, as long as no process is dead,
+    # a process killed (OOM, segfault) doesn't send anything
+    while True:
+        try:
+            return operation(timeout=0.1)
+        except (queue.Empty, queue.Full):
+            pass
+        for process in processes:
+            if dead(process):
+                try:
+                    return operation(timeout=1)  # what it sent right before exiting
+                except (queue.Empty, queue.Full):
+                    raise RuntimeError('{} exited with code {}'.format(process.name, process.exitcode))
+
+def bounded_results(submit, chunks, window):
+    # keep at most `window` chunks in flight, results are yielded in input order
+    pending = deque()
+    for chunk in chunks:
+        pending.append(submit(chunk))
+        if len(pending) >= window:
+            yield pending.popleft()()
+    while pending:
+        yield pending.popleft()()
+
+class Trace:
+    # trace sink, gets the outputs of every traced input record
+    # sample - fraction of records to trace, steps - names of traced steps (all if None)
+    def __init__(self, sample=1.0, steps=None, seed=None):
+        self.sample = sample
+        self.steps = None if steps is None else set(steps)
+        self._random = random.Random(seed)
+
+    def enabled(self, name):
+        # called before the step runs on a record, so the outputs of records
+        # which are not traced don't have to be materialized
+        if self.steps is not None and name not in self.steps:
+            return False
+        return self.sample >= 1 or self._random.random() < self.sample
+
+    def record(self, name, i, result):
+        raise NotImplementedError
+
+    def message(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+class PrintTrace(Trace):
+    # the default for verbose=True
+    def record(self, name, i, result):
+        for j in result:
+            print('{}: {} -> {}'.format(name, i, j))
+
+    def message(self, *args):
+        print(*args)
+
+class RingBufferTrace(Trace):
+    # keeps only the last maxlen (step name, input, output) events
+    def __init__(self, maxlen=10000, **kwargs):
+        super().__init__(**kwargs)
+        self.events = deque(maxlen=maxlen)
+
+    def record(self, name, i, result):
+        for j in result:
+            self.events.append((name, i, j))
+
+    def message(self, *args):
+        self.events.append((None, ' '.join(map(str, args)), None))
+
+class FileTrace(Trace):
+    # writes events as json lines, batches are written by a background thread
+    # so the pipeline doesn't wait for the disk
+    def __init__(self, path, batch_size=1000, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.batch_size = batch_size
+        self._batch = []
+        self._queue = queue.Queue(16)
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def _write(self):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for batch in iter(self._queue.get, None):
+                f.write(''.join(batch))
+                f.flush()
+
+    def _add(self, event):
+        self._batch.append(json.dumps(event) + '\n')
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def record(self, name, i, result):
+        now = time.time()
+        for j in result:
+            self._add({'time': now, 'step': name, 'input': repr(i), 'output': repr(j)})
+
+    def message(self, *args):
+        self._add({'time': time.time(), 'message': ' '.join(map(str, args))})
+
+    def flush(self):
+        if self._batch:
+            self._queue.put(self._batch)
+            self._batch = []
+
+    def close(self):
+        if self._thread.is_alive():
+            self.flush()
+            self._queue.put(None)
+            self._thread.join()
+
+_print_trace = PrintTrace()
+
+class StepStats:
+    # runtime metrics of a single step
+    # wall/cpu time is exclusive: the time spent pulling records from the previous
+    # step (in lazy mode) is not counted
+    def __init__(self, step):
+        function = getattr(step, 'function', None)
+        self.kind = getattr(step, 'kind', type(step).__name__.lower())
+        self.name = self.kind if function is None else function.__name__
+        self.input = 0
+        self.output = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.keys = Counter() if self.kind == 'reduce' else None
+        self.nested = None  # stats of the steps of repeated/discarded blocks
+        self._started = None
+
+    def start(self):
+        self._started = time.perf_counter(), time.process_time()
+
+    def stop(self):
+        if self._started is not None:
+            wall, cpu = self._started
+            self.wall += time.perf_counter() - wall
+            self.cpu += time.process_time() - cpu
+            self._started = None
+
+    def counted_input(self, x):
+        keys = self.keys
+        iterator = iter(x)
+        while True:
+            self.stop()
+            try:
+                i = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.start()
+            self.input += 1
+            if keys is not None:
+                keys[i[0]] += 1
+            yield i
+
+    def counted_output(self, x):
+        iterator = iter(x)
+        while True:
+            self.start()
+            try:
+                i = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.stop()
+            self.output += 1
+            yield i
+
+    def as_dict(self):
+        d = {
+            'step': self.name,
+            'kind': self.kind,
+            'input': self.input,
+            'output': self.output,
+            'wall': self.wall,
+            'cpu': self.cpu,
+        }
+        if self.keys is not None:
+            # group sizes are bucketed by powers of 2: {1: .., 2: 2-3, 4: 4-7, ...}
+            histogram = Counter(1 << (n.bit_length() - 1) for n in self.keys.values())
+            d['keys'] = len(self.keys)
+            d['group_sizes'] = dict(sorted(histogram.items()))
+            d['top_keys'] = self.keys.most_common(10)
+        if self.kind == 'repeated':
+            d['iterations'] = [[s.as_dict() for s in i] for i in self.nested or []]
+        elif self.nested is not None:
+            d['steps'] = [s.as_dict() for s in self.nested]
+        return d
+
 class MapReduceSteps:
-    def __init__(self, verbose=True, lazy=False):
+    def __init__(self, verbose=True, lazy=False, workers=None, chunksize=1000, executor=None,
+                 partitions=None, spill_threshold=None, spill_dir=None, fuse=True,
+                 collect_stats=False, checkpoint_dir=None, checkpoint_every=1, serializer=None,
+                 hot_key_threshold=10000):
         self.verbose = verbose
         self.lazy = lazy
+        self.fuse = fuse
+        self.collect_stats = collect_stats
+        self.workers = workers
+        self.chunksize = chunksize
+        self.executor = executor
+        self.partitions = partitions
+        self.spill_threshold = spill_threshold
+        self.spill_dir = spill_dir
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_every = checkpoint_every
+        self.serializer = serializer or default_serializer
+        self.hot_key_threshold = hot_key_threshold
         self.steps = []
+        self._stats = []
+        self._planned = None  # (steps, fused), plan
+
+    def _options(self):
+        # options inherited by nested blocks (repeated, discarded)
+        return dict(verbose=self.verbose, lazy=self.lazy, fuse=self.fuse, workers=self.workers,
+                    chunksize=self.chunksize, executor=self.executor,
+                    partitions=self.partitions, spill_threshold=self.spill_threshold,
+                    spill_dir=self.spill_dir, collect_stats=self.collect_stats,
+                    checkpoint_dir=self.checkpoint_dir, checkpoint_every=self.checkpoint_every,
+                    serializer=self.serializer, hot_key_threshold=self.hot_key_threshold)
+
+    def _run_step(self, func, x, stats, hints=None):
+        # hints are the keyword arguments of map and reduce steps set by a following take or top
+        if hints:
+            func = partial(func, **hints)
+        if not self.collect_stats:
+            return func(x)
+        s = StepStats(getattr(func, 'func', func))
+        stats.append(s)
+        s.start()
+        try:
+            # named inputs of a join are not counted
+            x = func(x if isinstance(x, Mapping) else s.counted_input(x))
+        finally:
+            s.stop()
+        # blocks start a new list of stats on every run
+        s.nested = getattr(getattr(func, 'func', func), '_stats', None)
+        if self.lazy or not isinstance(x, list):
+            return s.counted_output(x)
+        s.output = len(x)
+        return x
+
+    def stats(self):
+        # metrics of the last run, collected with collect_stats=True
+        return [s.as_dict() for s in self._stats]
 
-    def map(self, function):
+    def _plan(self):
+        # steps to run, adjacent map steps are fused into a single pass
+        # without intermediate lists
+        # traced output is recorded step by step, so nothing is fused then
+        # the plan is reused until the steps change, blocks are planned on every iteration
+        if not self.fuse or self.trace is not None:
+            return self.steps
+        if self._planned is not None and self._planned[0] == tuple(self.steps):
+            return self._planned[1]
+        steps = []
+        for step in self.steps:
+            kind = getattr(step, 'kind', None)
+            if (kind == 'map' and not is_async(step.function)
+                    and steps and getattr(steps[-1], 'kind', None) == 'map'
+                    and not is_async(steps[-1].function)):
+                functions = getattr(steps[-1].function, 'functions', (steps[-1].function,))
+                steps[-1] = self._map_step(compose(*functions, step.function))
+            else:
+                steps.append(step)
+        self._planned = tuple(self.steps), steps
+        return steps
+
+    def _grouper(self, agg=None):
+        # how a reduce step groups its input, None means the default mapdict
+        if agg is not None:
+            return partial(group_items, agg=agg)
+        if self.spill_threshold is not None:
+            return partial(external_group, threshold=self.spill_threshold, directory=self.spill_dir,
+                           serializer=self.serializer)
+        return None
+
+    @property
+    def parallel(self):
+        return self.executor is not None or (self.workers is not None and self.workers > 1)
+
+    @property
+    def trace(self):
+        # verbose is either a bool or a Trace sink
+        if isinstance(self.verbose, Trace):
+            return self.verbose
+        if self.verbose:
+            return _print_trace
+        return None
+
+    def _materialized(self, function, x):
+        # x yields (input, output list) pairs computed elsewhere (workers, chunks)
+        trace = self.trace
+
+        def map_func(i):
+            i, result = i
+            if trace is not None and trace.enabled(function.__name__):
+                trace.record(function.__name__, i, result)
+            return result
+        return flat_map(map_func, x)
+
+    def _worker_map(self, function, x, chunk_func=_map_chunk, chunksize=None):
+        # outputs of a map or combine function run by the workers, which send back
+        # the input records only when they are traced
+        if self.trace is None:
+            return self._parallel_map(function, x, partial(chunk_func, traced=False), chunksize)
+        return self._materialized(function, self._parallel_map(function, x, chunk_func, chunksize))
+
+    def _parallel_map(self, function, x, chunk_func=_map_chunk, chunksize=None):
+        # the records of the chunk_func(chunk, function) results
+        chunks = chunked(x, chunksize or self.chunksize)
+        if self.executor is not None:
+            window = 2 * (self.workers or os.cpu_count() or 1)
+            submit = lambda chunk: self.executor.submit(chunk_func, chunk, function).result
+            for chunk in bounded_results(submit, chunks, window):
+                yield from chunk
+        else:
+            # chunks are sent as serialized bytes
+            serializer = self.serializer
+            with mp_context().Pool(self.workers, _init_worker, (function,)) as pool:
+                def submit(chunk):
+                    result = pool.apply_async(_encoded_chunk, (serializer.dumps(chunk), chunk_func, serializer))
+                    return lambda: serializer.loads(result.get())
+                for chunk in bounded_results(submit, chunks, 2 * self.workers):
+                    yield from chunk
+
+    def _partitioned_reduce(self, function, group, x, salt_threshold=None, top=None):
+        # shuffle: records are hash-partitioned by key and every partition
+        # is grouped and reduced in its own process
+        # with salt_threshold (associative reducers), the values of a key after the first
+        # salt_threshold are spread over all partitions, and the partial results are reduced
+        # again here
+        n = self.partitions
+        counts = Counter() if salt_threshold is not None else None
+        salted = set()
+        context = mp_context()
+        outbox = context.Queue()
+        inboxes = [context.Queue(4) for _ in range(n)]
+        processes = [
+            context.Process(target=_reduce_partition,
+                            args=(function, group or group_items, p, inboxes[p], outbox,
+                                  self.trace is not None, self.serializer, top),
+                            daemon=True)
+            for p in range(n)
+        ]
+        for p, process in enumerate(processes):
+            process.name = 'partition {}'.format(p)
+            process.start()
+
+        def send(p, item):
+            while_alive(partial(inboxes[p].put, item), [processes[p]])
+
+        try:
+            buffers = [[] for _ in range(n)]
+            for pos, i in enumerate(x):
+                p = hash(i[0]) % n
+                if counts is not None:
+                    counts[i[0]] += 1
+                    count = counts[i[0]]
+                    if count > salt_threshold:
+                        salted.add(i[0])
+                        p = (p + count) % n
+                buffers[p].append((pos, i))
+                if len(buffers[p]) >= self.chunksize:
+                    send(p, self.serializer.dumps(buffers[p]))
+                    buffers[p] = []
+            for p in range(n):
+                if buffers[p]:
+                    send(p, self.serializer.dumps(buffers[p]))
+                send(p, None)
+            results = [None] * n
+            pending = set(range(n))
+            for _ in range(n):
+                p, result = while_alive(outbox.get, [processes[p] for p in pending])
+                if isinstance(result, BaseException):
+                    raise result
+                results[p] = self.serializer.loads(result)
+                pending.discard(p)
+            for process in processes:
+                process.join()
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+        merged = heapq.merge(*results, key=lambda r: r[0])
+        if salted:
+            merged = self._merge_salted(function, merged, salted)
+        for first, k, values, result in merged:
+            yield (k, values), result
+
+    def _merge_salted(self, function, merged, salted):
+        # a salted key has a partial result from every partition
+        output = []
+        partials = {}
+        for first, k, values, result in merged:
+            if k not in salted:
+                output.append((first, k, values, result))
+                continue
+            if k not in partials:
+                partials[k] = [first, k, [] if values is not None else None, []]
+            entry = partials[k]
+            if values is not None:
+                entry[2].extend(values)
+            entry[3].extend(v for _, v in result)
+        for first, k, values, partial_results in partials.values():
+            output.append((first, k, values, list(function(k, partial_results))))
+        output.sort(key=itemgetter(0))
+        return output
+
+    def map(self, function=None, concurrency=100, ordered=True):
+        if not callable(function):
+            # it's decorator with () call
+            return partial(self.map, concurrency=concurrency, ordered=ordered)
+
+        self.steps.append(self._map_step(function, concurrency, ordered))
+        return function
+
+    def _map_step(self, function, concurrency=100, ordered=True):
+        # async functions (async def returning the records or async generators)
+        # run on an event loop, up to `concurrency` calls at once,
+        # with ordered=False the output comes in the order the calls finish
+        def f(x, lazy=None):
+            trace = self.trace
+            call = function.loops if isinstance(function, Fused) else function  # one call less per record
+
+            def map_func(i):
+                result = call(i[0], i[1])
+
+                if trace is not None and trace.enabled(function.__name__):
+                    result = list(result)  # need to materialize, can't run iterable twice
+                    trace.record(function.__name__, i, result)
+                return result
+
+            if is_async(function):
+                result = self._materialized(function, async_map(function, x, concurrency, ordered))
+            elif self.parallel and isinstance(x, FileSource):
+                # every worker reads its own split of the file
+                splits = [(x, start, end) for start, end in x.splits()]
+                result = self._worker_map(function, splits, _map_splits, 1)
+            elif self.parallel:
+                result = self._worker_map(function, x)
+            else:
+                result = flat_map(map_func, x)
+
+            if self.lazy if lazy is None else lazy:
+                return result
+            else:
+                return list(result)  # evaluate
+
+        f.kind = 'map'
+        f.function = function
+        return f
+
+    def broadcast(self, function=None, multi=False):
         if not callable(function):
             # it's decorator with () call
-            return self.map
+            return partial(self.broadcast, multi=multi)
+
+        # side input: the records emitted by function are indexed by key into a read-only
+        # Broadcast mapping which replaces the decorated function, the records of the step
+        # itself pass through unchanged
+        # inside a repeated block, it is built only in the first iteration
+        b = Broadcast(function.__name__, multi)
 
         def f(x):
+            trace = self.trace
+            call = function.loops if isinstance(function, Fused) else function  # one call less per record
+
             def map_func(i):
-                result = function(i[0], i[1])
+                result = call(i[0], i[1])
 
-                if self.verbose:
+                if trace is not None and trace.enabled(function.__name__):
                     result = list(result)  # need to materialize, can't run iterable twice
-                    for j in result:
-                        print('{}: {} -> {}'.format(function.__name__, i, j))
+                    trace.record(function.__name__, i, result)
                 return result
-            result = flat_map(map_func, x)
 
+            def build():
+                records = list(x)
+                b._build(flat_map(map_func, records))
+                return records
+
+            # workers and partitions are forked before they pull any record, so they would get
+            # the mapping unbuilt, it's built right away then
+            forks = self.parallel or (self.partitions is not None and self.partitions > 1)
+            if self.lazy and not forks:
+                return itertools.chain.from_iterable(lazy_call(build))
+            else:
+                return build()  # evaluate
+
+        f.kind = 'broadcast'
+        f.function = function
+        f.once = True
+        self.steps.append(f)
+        return b
+
+    def combine(self, function):
+        if not callable(function):
+            # it's decorator with () call
+            return self.combine
+
+        # like reduce, but each chunk of records is grouped and reduced separately,
+        # the function must emit values which can be reduced again
+        def f(x):
+            if self.parallel:
+                result = self._worker_map(function, x, _combine_chunk)
+            else:
+                x = flat_map(partial(_combine_chunk, function=function), chunked(x, self.chunksize))
+                result = self._materialized(function, x)
             if self.lazy:
                 return result
             else:
                 return list(result)  # evaluate
 
+        f.kind = 'combine'
+        f.function = function
         self.steps.append(f)
         return function
 
-    def reduce(self, function):
+    def reduce(self, function=None, combiner=None, agg=None, concurrency=100, ordered=True,
+               associative=False, sort_values_by=None, reverse=False):
+        if agg is not None and sort_values_by is not None:
+            raise ValueError("aggregated values can't be sorted")
         if not callable(function):
             # it's decorator with () call
-            return self.reduce
+            return partial(self.reduce, combiner=combiner, agg=agg, concurrency=concurrency, ordered=ordered,
+                           associative=associative, sort_values_by=sort_values_by, reverse=reverse)
 
-        def f(x):
-            def reduce_func(a, b):
-                a[b[0]].append(b[1])
-                return a
-            x = lazy_reduce(reduce_func, x, mapdict())  # x is single item iterable
-            x = items_of_single(x)
+        if combiner is not None:
+            self.combine(combiner)
+
+        # with agg, the function gets the aggregated value instead of the list of values
+        # with sort_values_by, it gets an iterator of values sorted by that key, see sorted_group
+        # associative=True marks a reducer which yields (key, value) records that can be reduced again
+        # together with other values, so the groups of hot keys are split, see salted_group
+        salt = associative and agg is None and not is_async(function)
+
+        def f(x, lazy=None, top=None):
+            lazy = self.lazy if lazy is None else lazy
+            group = self._grouper(agg)
+            if sort_values_by is not None:
+                # async reducers run concurrently, traced values are recorded
+                materialize = is_async(function) or self.trace is not None
+                group = partial(sorted_group, sort_key=sort_values_by, reverse=reverse,
+                                threshold=self.spill_threshold, directory=self.spill_dir,
+                                serializer=self.serializer, materialize=materialize)
+            threshold = self.hot_key_threshold if salt else None
+            if threshold is not None:
+                group = partial(salted_group, function=function, threshold=threshold, group=group)
+            # async reducers run on the event loop of this process
+            if self.partitions is not None and self.partitions > 1 and not is_async(function):
+                # partial results of salted keys are not final, they can't be dropped
+                top = top if threshold is None else None
+                result = self._materialized(function, self._partitioned_reduce(function, group, x, threshold, top))
+                if lazy:
+                    return result
+                else:
+                    return list(result)  # evaluate
+
+            if agg is not None and self.parallel:
+                # every worker aggregates its chunks, like a combiner
+                x = merge_partials(agg, self._parallel_map(agg, x, _aggregate_chunk))
+            elif group is not None:
+                x = group(x)
+            else:
+                def reduce_func(a, b):
+                    a[b[0]].append(b[1])
+                    return a
+                x = lazy_reduce(reduce_func, x, mapdict())  # x is single item iterable
+                x = items_of_single(x)
+
+            trace = self.trace
+            call = function.loops if isinstance(function, Fused) else function  # one call less per record
 
             def map_func(i):
-                result = function(i[0], i[1])
+                result = call(i[0], i[1])
 
-                if self.verbose:
+                if trace is not None and trace.enabled(function.__name__):
                     result = list(result)  # need to materialize, can't run iterable twice
-                    for j in result:
-                        print('{}: {} -> {}'.format(function.__name__, i, j))
+                    trace.record(function.__name__, i, result)
                 return result
-            result = flat_map(map_func, x)
-            if self.lazy:
+
+            if is_async(function):
+                result = self._materialized(function, async_map(function, x, concurrency, ordered))
+            else:
+                result = flat_map(map_func, x)
+            if lazy:
                 return result
             else:
                 return list(result)  # evaluate
 
+        f.kind = 'reduce'
+        f.function = function
+        f.agg = agg
+        f.associative = associative
+        self.steps.append(f)
+        return function
+
+    def aggregate(self, *aggs):
+        # reduce step which yields key, aggregated value
+        # several aggregators are combined and yield a tuple of values
+        aggs = [AGGREGATORS[a]() if isinstance(a, str) else a for a in aggs]
+        agg = aggs[0] if len(aggs) == 1 else Multi(*aggs)
+
+        def aggregate(k, v):
+            yield k, v
+        aggregate.__name__ = repr(agg)
+
+        self.reduce(aggregate, agg=agg)
+        return agg
+
+    def map_batch(self, function):
+        # vectorized map: function(keys, values) gets a batch of chunksize records as NumPy arrays
+        # and returns the (keys, values) arrays of its output, the output is Columns
+        _require_numpy()
+
+        def f(x):
+            batches = (function(keys, values) for keys, values in to_batches(x, self.chunksize))
+            if self.lazy:
+                return Columns(batches=batches)
+            else:
+                return Columns(batches=list(batches))  # evaluate
+
+        f.kind = 'map_batch'
+        f.function = function
+        self.steps.append(f)
+        return function
+
+    def reduce_batch(self, function=None, stable=True):
+        if not callable(function):
+            # it's decorator with () call
+            return partial(self.reduce_batch, stable=stable)
+
+        # vectorized reduce: all the records are sorted by key at once (see group_columns),
+        # function(keys, values, starts) gets the unique keys, the values sorted by key and the
+        # start of the values of every key, and returns (keys, values) arrays, the output is Columns
+        # with stable=False, the values of a key are not in the input order
+        _require_numpy()
+
+        def f(x):
+            keys, values = Columns(batches=to_batches(x, self.chunksize)).concatenated()
+            if not len(keys):
+                return Columns(batches=[])
+            return Columns(*function(*group_columns(keys, values, stable)))
+
+        f.kind = 'reduce_batch'
+        f.function = function
         self.steps.append(f)
         return function
 
+    def aggregate_batch(self, *names):
+        # vectorized aggregate ('sum', 'count', 'min', 'max', 'mean'), several aggregates
+        # of 1-d values are the columns of the output values
+        aggs = [BATCH_AGGREGATORS[name] for name in names]
+
+        def aggregate(keys, values, starts):
+            if len(aggs) == 1:
+                return keys, aggs[0](values, starts)
+            return keys, np.column_stack([agg(values, starts) for agg in aggs])
+        aggregate.__name__ = 'batch {}'.format(', '.join(names))
+
+        self.reduce_batch(aggregate, stable=False)  # the order of values doesn't matter
+
+    def take(self, n):
+        # the first n records, the map and reduce steps before it stream their output,
+        # so a map-only pipeline stops reading its input after n records
+        def f(x):
+            result = itertools.islice(x, n)
+            if self.lazy:
+                return result
+            else:
+                return list(result)  # evaluate
+
+        f.kind = 'take'
+        f.function = None
+        f.options = (n,)
+        self.steps.append(f)
+
+    def top(self, n, key=None):
+        # the n largest records by key (the records themselves by default), largest first
+        # the steps before it stream their output into a bounded heap, and the partitions
+        # of a reduce right before it keep only their own n largest records
+        key = key or (lambda record: record)
+
+        def f(x):
+            return heapq.nlargest(n, x, key=key)
+
+        f.kind = 'top'
+        f.function = None
+        f.options = (n, key)
+        self.steps.append(f)
+
+    def _pushdown(self, steps):
+        # hints for the map and reduce steps before a take or top,
+        # and for the map steps before a combine, which streams them chunk by chunk
+        hints = [{} for _ in steps]
+        for index, step in enumerate(steps):
+            kind = getattr(step, 'kind', None)
+            previous = index - 1
+            if kind == 'combine':
+                while previous >= 0 and getattr(steps[previous], 'kind', None) == 'map':
+                    hints[previous]['lazy'] = True
+                    previous -= 1
+            if kind not in ('take', 'top'):
+                continue
+            if kind == 'top' and previous >= 0 and getattr(steps[previous], 'kind', None) == 'reduce':
+                hints[previous]['top'] = step.options
+            while previous >= 0 and getattr(steps[previous], 'kind', None) in ('map', 'reduce'):
+                hints[previous]['lazy'] = True
+                previous -= 1
+        return hints
+
+class Broadcast(Mapping):
+    # read-only index of a side input, see MapReduceSteps.broadcast
+    def __init__(self, name, multi=False):
+        self.name = name
+        self.multi = multi
+        self.built = False
+        self._data = {}
+
+    def _build(self, items):
+        if self.multi:
+            data = mapdict()
+            for k, v in items:
+                data[k].append(v)
+            data = dict(data)
+        else:
+            data = dict(items)
+        self._data = data
+        self.built = True
+
+    def __getitem__(self, key):
+        if not self.built:
+            raise RuntimeError('broadcast {} is used before it is built'.format(self.name))
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return 'Broadcast({}, {} keys)'.format(self.name, len(self._data))
+
+class Aggregator:
+    # incremental reduce: create() -> add(acc, value)... -> result(acc)
+    # merge(acc1, acc2) combines partial accumulators (e.g. of different chunks)
+    def create(self):
+        raise NotImplementedError
+
+    def add(self, acc, value):
+        raise NotImplementedError
+
+    def merge(self, a, b):
+        raise NotImplementedError
+
+    def result(self, acc):
+        return acc
+
+    def __repr__(self):
+        return '{}()'.format(type(self).__name__)
+
+class Sum(Aggregator):
+    # start must be neutral (0, 0.0), every partial accumulator starts with it
+    def __init__(self, start=0):
+        self.start = start
+
+    def create(self):
+        return self.start
+
+    def add(self, acc, value):
+        return acc + value
+
+    def merge(self, a, b):
+        return a + b
+
+class Count(Aggregator):
+    def create(self):
+        return 0
+
+    def add(self, acc, value):
+        return acc + 1
+
+    def merge(self, a, b):
+        return a + b
+
+class Min(Aggregator):
+    # like the built-in min(), key is applied to the values for comparison
+    def __init__(self, key=None):
+        self.key = key
+
+    def _better(self, a, b):
+        if self.key is None:
+            return b < a
+        return self.key(b) < self.key(a)
+
+    def create(self):
+        return _initial_missing
+
+    def add(self, acc, value):
+        if acc is _initial_missing or self._better(acc, value):
+            return value
+        return acc
+
+    def merge(self, a, b):
+        if b is _initial_missing:
+            return a
+        return self.add(a, b)
+
+class Max(Min):
+    def _better(self, a, b):
+        return super()._better(b, a)
+
+class Mean(Aggregator):
+    def create(self):
+        return 0, 0
+
+    def add(self, acc, value):
+        return acc[0] + value, acc[1] + 1
+
+    def merge(self, a, b):
+        return a[0] + b[0], a[1] + b[1]
+
+    def result(self, acc):
+        return acc[0] / acc[1]
+
+class Multi(Aggregator):
+    # several aggregators over the same values, the result is a tuple
+    def __init__(self, *aggs):
+        self.aggs = aggs
+
+    def create(self):
+        return tuple(a.create() for a in self.aggs)
+
+    def add(self, acc, value):
+        return tuple(a.add(i, value) for a, i in zip(self.aggs, acc))
+
+    def merge(self, x, y):
+        return tuple(a.merge(i, j) for a, i, j in zip(self.aggs, x, y))
+
+    def result(self, acc):
+        return tuple(a.result(i) for a, i in zip(self.aggs, acc))
+
+    def __repr__(self):
+        return 'Multi({})'.format(', '.join(map(repr, self.aggs)))
+
+AGGREGATORS = {
+    'sum': Sum,
+    'count': Count,
+    'min': Min,
+    'max': Max,
+    'mean': Mean,
+}
+
 class StopRepeated(Exception):
     pass
 
 class Discarded(MapReduceSteps):
+    kind = 'discarded'
+
     def __enter__(self):
         return self
 
@@ -97,17 +1977,30 @@ class Discarded(MapReduceSteps):
 
     def eval(self, x):
         initial_x = list(x)
-        for func in self.steps:
-            x = func(x)
+        x = initial_x
+        self._stats = stats = []
+        try:
+            for func in self._plan():
+                x = self._run_step(func, x, stats)
+            for _ in x:  # in lazy mode, the steps only run when their output is consumed
+                pass
+        except StopRepeated as e:
+            # the input was consumed here, the repeated block continues with the copy
+            e.data = initial_x
+            raise
         return initial_x
 
     def __call__(self, *args, **kwargs):
         return self.eval(*args, **kwargs)
 
 class Repeated(MapReduceSteps):
+    kind = 'repeated'
+
     def __init__(self, times=-1, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.times = times
         self.remaining = times
+        self.resume_state = None  # set by MapReduceTask.eval(resume=True)
 
     def __enter__(self):
         return self
@@ -116,7 +2009,10 @@ class Repeated(MapReduceSteps):
         return False
 
     def discarded(self, verbose=True):
-        d = Discarded(verbose=verbose, lazy=self.lazy)
+        options = self._options()
+        if verbose is not True or not isinstance(self.verbose, Trace):
+            options['verbose'] = verbose  # otherwise, use the same trace sink
+        d = Discarded(**options)
         self.steps.append(d)
         return d
 
@@ -124,39 +2020,501 @@ class Repeated(MapReduceSteps):
         raise StopRepeated
 
     def eval(self, x):
+        self._stats = []
+        return self._eval(x, self._stats)
+
+    def stats(self):
+        # per iteration
+        return [[s.as_dict() for s in iteration] for iteration in self._stats]
+
+    def _checkpoint(self, i, state):
+        # checkpoint_dir is the directory of the block, see MapReduceTask.repeated
+        if self.checkpoint_dir is not None and i % self.checkpoint_every == 0:
+            state.update(iteration=i, remaining=self.remaining)
+            save_checkpoint(self.checkpoint_dir, i, state, serializer=self.serializer)
+
+    def _start(self):
+        # iteration to start from and the resumed state
+        state, self.resume_state = self.resume_state, None
+        if state is None:
+            self.remaining = self.times  # every run (or window of a stream) starts over
+            if self.checkpoint_dir is not None:
+                for old in checkpoints(self.checkpoint_dir):
+                    os.remove(old)
+            return 0, None
+        self.remaining = state['remaining']
+        return state['iteration'], state
+
+    def _eval(self, x, stats):
+        i, state = self._start()
+        if state is not None:
+            x = state['x']
+        first = True
         try:
-            i = 0
             while self.remaining != 0:
-                if self.verbose:
-                    print('-' * 10, 'Repeat {}'.format(i), '-' * 10)
-                for func in self.steps:
-                    x = func(x)
+                if self.trace is not None:
+                    self.trace.message('-' * 10, 'Repeat {}'.format(i), '-' * 10)
+                iteration = []
+                stats.append(iteration)
+                for func in self._plan():
+                    if not first and getattr(func, 'once', False):
+                        continue
+                    x = self._run_step(func, x, iteration)
                 if self.remaining > 0:
                     self.remaining -= 1
                 i += 1
-        except StopRepeated:
-            if self.verbose:
-                print('-' * 10, 'break', '-' * 10)
+                first = False
+                if self.checkpoint_dir is not None and i % self.checkpoint_every == 0:
+                    x = list(x)  # in lazy mode, a checkpoint evaluates the iteration
+                    self._checkpoint(i, {'x': x})
+        except StopRepeated as e:
+            x = getattr(e, 'data', x)
+            if self.trace is not None:
+                self.trace.message('-' * 10, 'break', '-' * 10)
         for i in x:
             yield i
 
     def __call__(self, *args, **kwargs):
         return self.eval(*args, **kwargs)
 
+class DeltaRepeated(Repeated):
+    # delta iteration: the records are kept in a solution set (key -> list of values)
+    # and every iteration only runs on the records of the keys in the workset,
+    # the keys which changed in the previous iteration
+    # the records emitted for a key of the workset replace its records in the solution set,
+    # the records emitted for other keys are added to their records (e.g. messages in BFS)
+    # the block stops when the workset is empty
+    def __init__(self, times=-1, changed=None, *args, **kwargs):
+        super().__init__(times, *args, **kwargs)
+        # changed(old values, new values) -> bool, e.g. to stop at some tolerance
+        self.changed = changed if changed is not None else (lambda old, new: old != new)
+
+    def _eval(self, x, stats):
+        i, state = self._start()
+        if state is None:
+            x = list(x)
+            solution = dict(group_items(x))
+            workset = dict.fromkeys(solution)
+        else:
+            solution, workset = state['solution'], state['workset']
+        first = True
+        try:
+            while self.remaining != 0 and workset:
+                if self.trace is not None:
+                    self.trace.message('-' * 10, 'Repeat {} ({} keys)'.format(i, len(workset)), '-' * 10)
+                iteration = []
+                stats.append(iteration)
+                if i > 0:
+                    x = [(k, v) for k in workset for v in solution[k]]
+                for func in self._plan():
+                    if not first and getattr(func, 'once', False):
+                        continue
+                    x = self._run_step(func, x, iteration)
+                output = dict(group_items(x))
+                for k in workset:
+                    if k not in output:
+                        del solution[k]
+                new_workset = {}
+                for k, values in output.items():
+                    if k not in workset:
+                        values = solution.get(k, []) + values
+                    if k not in solution or self.changed(solution[k], values):
+                        new_workset[k] = None
+                    solution[k] = values
+                workset = new_workset
+                if self.remaining > 0:
+                    self.remaining -= 1
+                i += 1
+                first = False
+                self._checkpoint(i, {'solution': solution, 'workset': workset})
+        except StopRepeated:
+            if self.trace is not None:
+                self.trace.message('-' * 10, 'break', '-' * 10)
+        for k, values in solution.items():
+            for v in values:
+                yield k, v
+
 class MapReduceTask(MapReduceSteps):
-    def __init__(self, verbose=True, lazy=False):
-        super().__init__(verbose, lazy)
+    def __init__(self, verbose=True, lazy=False, cache=None, pipeline=None, queue_size=4, state=None, **kwargs):
+        super().__init__(verbose, lazy, **kwargs)
+        self.cache = cache  # StageCache
+        self.state = state  # StateStore of incremental runs
+        if pipeline not in (None, 'thread', 'process'):
+            raise ValueError('unknown pipeline {!r}'.format(pipeline))
+        self.pipeline = pipeline
+        self.queue_size = queue_size
+
+    def _block_options(self):
+        # every repeated block has its own checkpoint directory
+        options = self._options()
+        if self.checkpoint_dir is not None:
+            options['checkpoint_dir'] = os.path.join(
+                self.checkpoint_dir, 'repeated-{}'.format(len(self.steps)))
+        return options
 
     def repeated(self, times=-1):
-        r = Repeated(times, verbose=self.verbose, lazy=self.lazy)
+        r = Repeated(times, **self._block_options())
+        self.steps.append(r)
+        return r
+
+    def delta_repeated(self, times=-1, changed=None):
+        r = DeltaRepeated(times, changed, **self._block_options())
         self.steps.append(r)
         return r
 
-    def eval(self, input_val):
-        x = enumerate(input_val)
-        for func in self.steps:
-            x = func(x)
+    def join(self, left, right, how='inner', strategy='auto', broadcast_threshold=10 ** 6):
+        # the first step of a task with named inputs, which are iterables of (key, value) records:
+        # t.join('orders', 'customers'); t({'orders': ..., 'customers': ...})
+        # outputs (key, (left value, right value)), how: inner, left, right or outer
+        # strategy: 'hash' indexes the right side in memory, 'sort_merge' sorts both sides (spilled
+        # with spill_threshold) and holds only the left records of one key, 'auto' uses a hash join
+        # if the right side has at most broadcast_threshold records
+        if how not in _join_types:
+            raise ValueError('unknown join type {!r}'.format(how))
+        if strategy not in ('auto', 'hash', 'sort_merge'):
+            raise ValueError('unknown join strategy {!r}'.format(strategy))
+        if self.steps:
+            raise ValueError('a join has to be the first step of a task')
+
+        def f(inputs):
+            left_records = inputs[left]
+            right_records = inputs[right]
+            use_hash = strategy == 'hash'
+            if strategy == 'auto':
+                right_records = iter(right_records)
+                head = list(itertools.islice(right_records, broadcast_threshold + 1))
+                use_hash = len(head) <= broadcast_threshold
+                right_records = itertools.chain(head, right_records)
+            if use_hash:
+                result = hash_join(left_records, right_records, how)
+            else:
+                result = sort_merge_join(left_records, right_records, how, self.spill_threshold,
+                                         self.spill_dir, self.serializer)
+            if self.lazy:
+                return result
+            else:
+                return list(result)  # evaluate
+
+        f.kind = 'join'
+        f.function = None
+        f.options = (left, right, how, strategy)
+        self.steps.append(f)
+        return f
+
+    def _input(self, input_val):
+        # file sources are keyed by byte offsets, named inputs of a join and columns are passed as they are
+        if isinstance(input_val, (FileSource, Columns)):
+            return input_val
+        if isinstance(input_val, Mapping) and self.steps and getattr(self.steps[0], 'kind', None) == 'join':
+            return input_val
+        return enumerate(input_val)
+
+    def _resume(self, steps):
+        # index of the last repeated block with a checkpoint, its state is loaded into it
+        for index in reversed(range(len(steps))):
+            func = steps[index]
+            if isinstance(func, Repeated) and func.checkpoint_dir is not None:
+                state = load_checkpoint(func.checkpoint_dir, func.serializer)
+                if state is not None:
+                    func.resume_state = state
+                    return index
+        return 0
+
+    @staticmethod
+    def _materialize(x):
+        if isinstance(x, Mapping):
+            return {name: list(records) for name, records in x.items()}
+        return list(x)
+
+    def _stage_keys(self, x, steps):
+        # cache key of the output of every step, None from the first step which can't be fingerprinted
+        key = records_digest(sorted(x.items()) if isinstance(x, Mapping) else x)
+        keys = []
+        for step in steps:
+            try:
+                key = hashlib.sha256((key + step_fingerprint(step)).encode()).hexdigest()
+            except _Undigestible:
+                return keys + [None] * (len(steps) - len(keys))
+            keys.append(key)
+        return keys
+
+    def _eval_cached(self, x, steps, stats):
+        # starts after the last step with a cached output,
+        # but broadcasts have to run to be built
+        x = self._materialize(x)
+        keys = self._stage_keys(x, steps)
+        broadcasts = [i for i, step in enumerate(steps) if getattr(step, 'kind', None) == 'broadcast']
+        start = 0
+        for index in reversed(range(min(broadcasts + [len(steps)]))):
+            cached = self.cache.get(keys[index]) if keys[index] is not None else None
+            if cached is not None:
+                x = cached
+                start = index + 1
+                break
+        for index in range(start, len(steps)):
+            x = list(self._run_step(steps[index], x, stats))
+            if keys[index] is not None:
+                self.cache.put(keys[index], x)
         return x
 
+    def invalidate_cache(self, input_val):
+        # removes the cached outputs of all the steps for this input
+        keys = self._stage_keys(self._materialize(self._input(input_val)), self._plan())
+        for key in keys:
+            if key is not None:
+                self.cache.invalidate(key)
+
+    def eval(self, input_val, resume=False, sink=None):
+        # with a sink, the output is written to its files and their paths are returned,
+        # in lazy mode the output is never held in memory
+        x = self._eval(input_val, resume)
+        if sink is not None:
+            return sink.write(x)
+        return x
+
+    def _eval(self, input_val, resume=False):
+        # with resume=True, the evaluation continues from the latest checkpoint
+        # of a repeated block, the steps before it are skipped
+        # (except broadcasts, which are built from the input again)
+        # with a cache, the output of every step is materialized and cached
+        x = self._input(input_val)
+        self._stats = stats = []
+        steps = self._plan()
+        if self.state is not None:
+            return self._eval_incremental(x, steps, stats)
+        if self.cache is not None and not resume:
+            return self._eval_cached(x, steps, stats)
+        start = self._resume(steps) if resume else 0
+        if any(getattr(func, 'kind', None) == 'broadcast' for func in steps[:start]):
+            for func in steps[:start]:
+                x = self._run_step(func, x, stats)
+            for _ in x:
+                pass
+        hints = self._pushdown(steps)
+        if self.pipeline is not None and start < len(steps):
+            x = self._pipelined(x, steps[start:], stats, hints[start:])
+            return x if self.lazy else list(x)
+        for index in range(start, len(steps)):
+            x = self._run_step(steps[index], x, stats, hints[index])
+        return x
+
+    @staticmethod
+    def _stateful_reduce(steps):
+        # index of the reduce step of an incremental task: maps and combines, the reduce, maps
+        kinds = [getattr(step, 'kind', None) for step in steps]
+        if kinds.count('reduce') != 1:
+            raise ValueError('an incremental task has to have a single reduce step')
+        index = kinds.index('reduce')
+        if (any(kind not in ('map', 'combine') for kind in kinds[:index])
+                or any(kind != 'map' for kind in kinds[index + 1:])):
+            raise ValueError('an incremental task can have only map and combine steps besides the reduce')
+        reduce_step = steps[index]
+        if reduce_step.agg is None and not reduce_step.associative:
+            raise ValueError('the reduce step of an incremental task needs an aggregator or associative=True')
+        return index
+
+    def _eval_incremental(self, x, steps, stats):
+        # the input is new records, which are reduced together with the stored state of their keys
+        # (aggregator accumulators or the outputs of an associative reducer), the output is only
+        # for those keys
+        index = self._stateful_reduce(steps)
+        for step in steps[:index]:
+            x = self._run_step(step, x, stats)
+        function, agg = steps[index].function, steps[index].agg
+        output = []
+        if agg is not None:
+            new = _aggregate_chunk(x, agg)
+            stored = self.state.get_many(k for k, _ in new)
+            states = [(k, agg.merge(stored[k], acc) if k in stored else acc) for k, acc in new]
+            for k, acc in states:
+                output.extend(function(k, agg.result(acc)))
+        else:
+            groups = list(group_items(x))
+            stored = self.state.get_many(k for k, _ in groups)
+            states = []
+            for k, values in groups:
+                result = list(function(k, stored.get(k, []) + values))
+                states.append((k, [v for _, v in result]))
+                output.extend(result)
+        self.state.put_many(states)
+        x = output
+        for step in steps[index + 1:]:
+            x = self._run_step(step, x, stats)
+        return x
+
+    def results(self):
+        # the output for all the keys in the state of an incremental task, like a run on all the input so far
+        steps = self._plan()
+        index = self._stateful_reduce(steps)
+        function, agg = steps[index].function, steps[index].agg
+
+        def reduced():
+            for k, state in self.state.items():
+                if agg is not None:
+                    yield from function(k, agg.result(state))
+                else:
+                    for v in state:
+                        yield k, v
+
+        x = reduced()
+        for step in steps[index + 1:]:
+            x = self._run_step(step, x, [])
+        return list(x)
+
+    def _run_stage(self, step, inbox, outbox, stats, hints):
+        x = inbox.records() if isinstance(inbox, _Pipe) else inbox
+        try:
+            for batch in chunked(self._run_step(step, x, stats, hints), self.chunksize):
+                if not outbox.send(batch):
+                    break  # the reader stopped
+            else:
+                outbox.put('end')
+        except BaseException as e:
+            outbox.put('error', picklable_error(e) if outbox.serializer is not None else e)
+        finally:
+            if isinstance(inbox, _Pipe):
+                x.close()  # stops the previous stage too
+            if outbox.closed.is_set() and outbox.serializer is not None:
+                outbox.queue.cancel_join_thread()  # nobody reads the rest
+
+    def _pipelined(self, x, steps, stats, hints):
+        # every step runs in its own thread or process, they are connected by queues of at most
+        # queue_size batches of chunksize records, and stream their output like in lazy mode
+        # processes are forked at the start, so they can't see broadcasts built by other steps,
+        # and their stats and trace events stay in them (only printed traces work)
+        processes = self.pipeline == 'process'
+        if processes and (self.collect_stats or any(getattr(step, 'kind', None) == 'broadcast' for step in steps)):
+            raise ValueError("broadcasts and stats are not supported in a process pipeline")
+        if processes and self.trace is not None and not isinstance(self.trace, PrintTrace):
+            raise ValueError("only printed traces are supported in a process pipeline")
+        context = mp_context() if processes else _threads
+        pipes = [_Pipe(context, self.queue_size, self.serializer if processes else None) for _ in steps]
+        stage_stats = [[] for _ in steps]
+        workers = []
+        inbox = x
+        for index, step in enumerate(steps):
+            step_hints = dict(hints[index])
+            if getattr(step, 'kind', None) in ('map', 'reduce'):
+                step_hints['lazy'] = True
+            workers.append(context.Process(target=self._run_stage, daemon=not processes,
+                                           args=(step, inbox, pipes[index], stage_stats[index], step_hints)))
+            inbox = pipes[index]
+        for index, worker in enumerate(workers):
+            worker.name = 'stage {}'.format(index)
+            worker.start()
+        try:
+            # a stage process can only be watched by the parent
+            yield from pipes[-1].records(workers if processes else None)
+        finally:
+            pipes[-1].closed.set()
+            for worker in workers:
+                worker.join(None if not processes else 1)
+                if processes and worker.is_alive():
+                    worker.terminate()
+            for s in stage_stats:
+                stats.extend(s)
+
+    def stream(self, input_val, size, slide=None, by='count', timestamp=None):
+        # windowed evaluation of an unbounded input, yields (start, end, output) for every window
+        # by='count': windows of `size` records every `slide` records (tumbling without slide)
+        # by='time': windows of `size` seconds every `slide` seconds, by the timestamp(value) of
+        # the records (a late record goes to the current window), or by the arrival time if timestamp
+        # is None, then a window is emitted when its time is over, even if no record comes
+        # the map steps before the first other step run once per record, the rest of the steps
+        # run on every window, only the records of the open windows are kept
+        if by not in ('count', 'time'):
+            raise ValueError('unknown window type {!r}'.format(by))
+        slide = slide or size
+        n = int(round(size / slide))
+        if n < 1 or abs(n * slide - size) > 1e-9 * size:
+            raise ValueError('the size of a window has to be a multiple of its slide')
+        steps = self._plan()
+        prefix = 0
+        while prefix < len(steps) and getattr(steps[prefix], 'kind', None) == 'map':
+            prefix += 1
+
+        def run(x, steps):
+            for step in steps:
+                x = self._run_step(step, x, [])
+            return list(x)
+
+        if by == 'count':
+            panes = ((pos // slide, (pos, v)) for pos, v in enumerate(input_val))
+        elif timestamp is not None:
+            panes = ((int(timestamp(v) // slide), (pos, v)) for pos, v in enumerate(input_val))
+        else:
+            panes = self._arrival_panes(input_val, slide)
+        return self._windows(panes, n, slide, by == 'count', partial(run, steps=steps[:prefix]),
+                             partial(run, steps=steps[prefix:]))
+
+    def _arrival_panes(self, input_val, slide):
+        # (pane, record) by arrival time, read by a thread, (pane, None) when a pane is over
+        pipe = _Pipe(_threads, self.queue_size * self.chunksize)
+
+        def read():
+            try:
+                for i in enumerate(input_val):
+                    if not pipe.put('data', i):
+                        return
+                pipe.put('end')
+            except BaseException as e:
+                pipe.put('error', e)
+
+        threading.Thread(target=read, daemon=True).start()
+        try:
+            pane = int(time.time() // slide)
+            while True:
+                try:
+                    kind, payload = pipe.queue.get(timeout=max((pane + 1) * slide - time.time(), 0))
+                except queue.Empty:
+                    pane = int(time.time() // slide)
+                    yield pane, None  # closes the previous panes
+                    continue
+                if kind == 'end':
+                    return
+                if kind == 'error':
+                    raise payload
+                pane = max(pane, int(time.time() // slide))
+                yield pane, payload
+        finally:
+            pipe.closed.set()
+
+    @staticmethod
+    def _windows(panes, n, slide, count, map_pane, reduce_window):
+        # panes: (pane index, record or None) in the order of indexes, a window is n panes
+        # a pane of `slide` records (count) is closed right away, not when the next record comes
+        closed = deque()  # (index, map output) of the panes of open windows
+        current = None
+        records = []
+
+        def close(until):
+            # closes the panes before `until` and emits the windows ending with them
+            nonlocal current, records
+            while current is not None and current < until:
+                if records:
+                    closed.append((current, map_pane(records)))
+                    records = []
+                while closed and closed[0][0] <= current - n:
+                    closed.popleft()  # the state of a window is freed when it's over
+                if not closed:
+                    current = until  # no windows until the next record
+                    break
+                start = (current - n + 1) * slide
+                yield max(start, 0) if count else start, (current + 1) * slide, reduce_window(
+                    itertools.chain.from_iterable(output for _, output in closed))
+                current += 1
+
+        for index, record in panes:
+            if current is None:
+                current = index
+            elif index > current:
+                yield from close(index)
+            if record is not None:
+                records.append(record)
+                if count and len(records) == slide:
+                    yield from close(current + 1)
+        if current is not None:
+            yield from close(current + n)
+
     def __call__(self, *args, **kwargs):
         return self.eval(*args, **kwargs)
@@ -14,10 +14,13 @@ setuptools.setup(
     url="https://github.com/File5/simple-mapreduce",
     license="MIT",
     packages=['mapreduce'],
+    extras_require={
+        'batch': ['numpy'],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.5',
+    python_requires='>=3.6',
 )
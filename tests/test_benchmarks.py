@@ -0,0 +1,27 @@
+import pytest
+
+from benchmarks.workloads import WORKLOADS
+from benchmarks.run import run_case
+
+
+def test_workloads():
+    for name in WORKLOADS:
+        for lazy in [False, True]:
+            case = {
+                'workload': name,
+                'records': 400,
+                'distribution': 'zipf',
+                'lazy': lazy,
+                'verbose': False,
+                'step_stats': True,
+            }
+            result = run_case(case)
+            assert result['output_records'] > 0
+            assert result['steps']
+
+
+def test_batch_benchmark(capsys):
+    pytest.importorskip('numpy')
+    from benchmarks.batch import run
+    run(1000)
+    assert 'sum_by_key' in capsys.readouterr().out
@@ -1,4 +1,15 @@
+from collections import Counter, namedtuple
+import itertools
+import json
+import os
+from operator import itemgetter
+import struct
+import zlib
+
+import pytest
+
 from mapreduce import MapReduceTask
+from mapreduce.mapreduce import group_items
 
 def test_flat_map():
     def f(x):
@@ -359,6 +370,27 @@ def test_repeated_inf_break_discarded():
     ]
 
 
+def test_repeated_discarded_stop_lazy():
+    # in lazy mode the discarded block runs its steps too, and a stop in it
+    # ends the repeated block with the input of the discarded block
+    for lazy in [False, True]:
+        t = MapReduceTask(verbose=False, lazy=lazy)
+
+        with t.repeated(20) as repeated:  # stopped after 6 iterations
+            @repeated.map
+            def double(k, v):
+                yield k, v * 2
+
+            with repeated.discarded(verbose=False) as discarded:
+                @discarded.map
+                def check(k, v):
+                    if v >= 100:
+                        repeated.stop()
+                    yield k, v
+
+        assert list(t([3, 5])) == [(0, 96), (1, 160)]
+
+
 def test_repeated_inf_break_discarded_lazy():
     t = MapReduceTask(verbose=True, lazy=True)
 
@@ -415,3 +447,1348 @@ def test_repeated_inf_break_discarded_lazy():
         assert False, "should not be evaluated"
     else:
         assert True
+
+
+def word_count_task(**kwargs):
+    t = MapReduceTask(**kwargs)
+
+    @t.map
+    def m1(k, v):
+        for word in v.split(' '):
+            yield word, 1
+
+    @t.reduce
+    def r1(k, v):
+        yield k, sum(v)
+
+    return t
+
+
+def test_map_workers():
+    x = ["hello world word world of words", "world of hello"] * 50
+    expected = list(word_count_task(verbose=False)(x))
+    t = word_count_task(verbose=False, workers=2, chunksize=7)
+    assert list(t(x)) == expected
+
+
+def test_map_workers_lazy():
+    t = MapReduceTask(verbose=False, lazy=True, workers=2, chunksize=3)
+
+    @t.map
+    def m1(k, v):
+        yield v, k * 2
+
+    assert list(t(range(10))) == [(i, i * 2) for i in range(10)]
+
+
+def test_map_executor():
+    from concurrent.futures import ThreadPoolExecutor
+    x = ["hello world word world of words"] * 10
+    expected = list(word_count_task(verbose=False)(x))
+    with ThreadPoolExecutor(2) as executor:
+        t = word_count_task(verbose=True, executor=executor, chunksize=4)
+        print('')
+        assert list(t(x)) == expected
+
+
+def split_words(k, v):
+    for word in v.split():
+        yield word, 1
+
+
+def lower_words(k, v):
+    yield k.lower(), v
+
+
+def test_fused_map_process_executor():
+    from concurrent.futures import ProcessPoolExecutor
+    # the fused step is pickled with the functions it runs
+    x = ["Hello world", "hello"] * 5
+    with ProcessPoolExecutor(2) as executor:
+        for fuse in [False, True]:
+            t = MapReduceTask(verbose=False, executor=executor, chunksize=3, fuse=fuse)
+            t.map(split_words)
+            t.map(lower_words)
+            t.aggregate('sum')
+            assert t(x) == [('hello', 10), ('world', 5)]
+
+
+def test_map_workers_send_outputs():
+    from concurrent.futures import ThreadPoolExecutor
+    from mapreduce import RingBufferTrace
+    # without a trace the workers send back only the outputs, not the input records
+
+    class Executor(ThreadPoolExecutor):
+        def submit(self, *args):
+            future = super().submit(*args)
+            results.append(future)
+            return future
+
+    x = ["hello world", "world"]
+    for trace, sent in [(False, ('hello', 1)), (RingBufferTrace(), ((0, 'hello world'), [('hello', 1), ('world', 1)]))]:
+        results = []
+        with Executor(2) as executor:
+            t = word_count_task(verbose=trace, executor=executor, chunksize=4)
+            assert t(x) == [('hello', 1), ('world', 2)]
+        assert results[0].result()[0] == sent
+
+
+def test_reduce_partitions():
+    x = ["hello world word world of words", "world of hello"] * 50
+    expected = list(word_count_task(verbose=False)(x))
+    t = word_count_task(verbose=True, partitions=3, chunksize=5)
+    print('')
+    assert list(t(x)) == expected
+
+
+def test_reduce_partitions_error():
+    t = MapReduceTask(verbose=False, partitions=2)
+
+    @t.reduce
+    def r1(k, v):
+        raise ValueError(k)
+        yield k, v
+
+    try:
+        list(t(range(3)))
+    except ValueError:
+        pass
+    else:
+        assert False, "error in the partition worker should be raised"
+
+
+def test_combine():
+    t = MapReduceTask(verbose=False, chunksize=4)
+    combined = []
+
+    @t.map
+    def m1(k, v):
+        for word in v.split(' '):
+            yield word, 1
+
+    @t.combine
+    def c1(k, v):
+        combined.append((k, v))
+        yield k, sum(v)
+
+    @t.reduce
+    def r1(k, v):
+        yield k, sum(v)
+
+    x = ["a b a a", "b a c a"]
+    assert list(t(x)) == [('a', 5), ('b', 2), ('c', 1)]
+    assert combined == [('a', [1, 1, 1]), ('b', [1]), ('b', [1]), ('a', [1, 1]), ('c', [1])]
+
+
+def test_combine_streams_map():
+    # in eager mode too, the map output isn't materialized before the combiner reads it
+    events = []
+    t = MapReduceTask(verbose=False, chunksize=10, collect_stats=True)
+
+    @t.map
+    def m1(k, v):
+        events.append('map')
+        yield v % 3, 1
+
+    @t.combine
+    def c1(k, v):
+        events.append('combine')
+        yield k, sum(v)
+
+    t.aggregate('sum')
+
+    assert t(range(100)) == [(0, 34), (1, 33), (2, 33)]
+    assert events.index('combine') < events.index('map', 20)
+    assert t.stats()[0]['output'] == 100
+
+
+def test_reduce_combiner():
+    x = ["hello world word world of words", "world of hello"] * 50
+    expected = list(word_count_task(verbose=False)(x))
+
+    def c1(k, v):
+        yield k, sum(v)
+
+    for options in [{}, {'workers': 2}]:
+        t = MapReduceTask(verbose=False, chunksize=16, **options)
+
+        @t.map
+        def m1(k, v):
+            for word in v.split(' '):
+                yield word, 1
+
+        @t.reduce(combiner=c1)
+        def r1(k, v):
+            assert len(v) < 50
+            yield k, sum(v)
+
+        assert list(t(x)) == expected
+
+
+def test_external_group():
+    from mapreduce.mapreduce import external_group
+    items = [(i % 7, i) for i in range(100)]
+    expected = dict(group_items(items))
+    groups = list(external_group(iter(items), threshold=9))
+    assert groups == list(expected.items())  # in the order of the first records, values in input order
+
+
+def test_spill_merge_fan_in():
+    from mapreduce.mapreduce import external_group, sorted_group, sort_merge_join, _SpilledRuns
+    # 2000 records in runs of 5, merged 3 by 3 on several levels
+    items = [(i % 13, i) for i in range(2000)]
+    assert dict(external_group(iter(items), threshold=5, fan_in=3)) == dict(group_items(items))
+    groups = list(sorted_group(iter(items), lambda v: -v, threshold=5, fan_in=3, materialize=True))
+    assert groups == [(k, sorted(v, reverse=True)) for k, v in group_items(items)]
+    joined = list(sort_merge_join(iter(items), iter([(3, 'a'), (4, 'b')]), threshold=5, fan_in=3))
+    assert sorted(joined) == sorted((k, (v, 'ab'[k - 3])) for k, v in items if k in (3, 4))
+
+    runs = _SpilledRuns(fan_in=3)
+    for i in range(100):
+        runs.add([(i % 5, i)])
+        assert len(runs) <= 2 * 5  # at most fan_in - 1 runs on each level
+    assert list(runs.merged()) == sorted(((i % 5, i) for i in range(100)), key=itemgetter(0))
+    assert len(runs) <= 3
+    runs.close()
+
+
+def test_reduce_spill():
+    x = ["hello world word world of words", "world of hello"] * 50
+    expected = sorted(word_count_task(verbose=False)(x))
+    for options in [{}, {'partitions': 2}]:
+        t = word_count_task(verbose=False, spill_threshold=10, **options)
+        assert sorted(t(x)) == expected
+    # spilling doesn't change the order of the keys
+    assert word_count_task(verbose=False, spill_threshold=3)(x) == word_count_task(verbose=False)(x)
+
+
+def test_aggregate():
+    from mapreduce import Max
+    for options in [{}, {'workers': 2, 'chunksize': 2}, {'partitions': 2}]:
+        t = MapReduceTask(verbose=True, **options)
+
+        @t.map
+        def m1(k, v):
+            yield v, 1
+
+        t.aggregate('sum')
+
+        @t.map
+        def m2(k, v):
+            yield 'all', (k, v)
+
+        @t.reduce(agg=Max(key=lambda i: i[1]))
+        def r2(k, v):
+            yield 'max', v
+
+        x = [1,2,3,1,2,1,4,5,6]
+        print('')
+        assert list(t(x)) == [('max', (1, 3))]
+
+
+def test_aggregate_multi():
+    t = MapReduceTask(verbose=False)
+
+    @t.map
+    def m1(k, v):
+        yield v[0], v[1]
+
+    t.aggregate('count', 'sum', 'min', 'max', 'mean')
+
+    x = [('a', 1), ('b', 4), ('a', 3), ('a', 2)]
+    assert list(t(x)) == [('a', (3, 6, 1, 3, 2.0)), ('b', (1, 4, 4, 4, 4.0))]
+
+
+def test_aggregators_merge():
+    from mapreduce import Sum, Count, Min, Mean, Multi
+    agg = Multi(Sum(), Count(), Min(), Mean())
+    a = agg.create()
+    for v in [3, 1]:
+        a = agg.add(a, v)
+    b = agg.add(agg.create(), 8)
+    assert agg.result(agg.merge(a, b)) == (12, 3, 1, 4.0)
+    assert agg.result(agg.merge(a, agg.create()))[2] == 1
+
+
+def test_fuse_maps():
+    calls = []
+    for fuse in [False, True]:
+        t = MapReduceTask(verbose=False, fuse=fuse)
+
+        @t.map
+        def m1(k, v):
+            calls.append('m1')
+            yield v, v * 2
+
+        @t.map
+        def m2(k, v):
+            calls.append('m2')
+            yield k, v
+            yield k, v + 1
+
+        @t.map
+        def m3(k, v):
+            calls.append('m3')
+            yield v, k
+
+        @t.reduce
+        def r1(k, v):
+            yield k, v
+
+        assert len(t._plan()) == (4 if not fuse else 2)
+        assert list(t(range(3))) == [(0, [0]), (1, [0]), (2, [1]), (3, [1]), (4, [2]), (5, [2])]
+    assert calls[:9] == ['m1'] * 3 + ['m2'] * 3 + ['m3'] * 3
+    assert calls[12:17] == ['m1', 'm2', 'm3', 'm3', 'm1']
+    # the plan is reused until a step is added
+    assert t._plan() is t._plan()
+    plan = t._plan()
+
+    @t.map
+    def m4(k, v):
+        yield k, v
+
+    assert t._plan() is not plan and len(t._plan()) == 3
+
+
+def test_print_trace(capsys):
+    t = word_count_task(verbose=True)
+    list(t(["b a b"]))
+    assert capsys.readouterr().out.splitlines() == [
+        "m1: (0, 'b a b') -> ('b', 1)",
+        "m1: (0, 'b a b') -> ('a', 1)",
+        "m1: (0, 'b a b') -> ('b', 1)",
+        "r1: ('b', [1, 1]) -> ('b', 2)",
+        "r1: ('a', [1]) -> ('a', 1)",
+    ]
+
+
+def test_ring_buffer_trace():
+    from mapreduce import RingBufferTrace
+    trace = RingBufferTrace(maxlen=3, steps=['m1'])
+    t = word_count_task(verbose=trace)
+    list(t(["a b c d e"]))
+    assert list(trace.events) == [('m1', (0, 'a b c d e'), (w, 1)) for w in 'cde']
+
+    trace = RingBufferTrace(sample=0.5, seed=1)
+    t = word_count_task(verbose=trace)
+    list(t(["a"] * 1000))
+    assert 400 < len(trace.events) < 600
+
+
+def test_file_trace(tmp_path):
+    import json
+    from mapreduce import FileTrace
+    path = str(tmp_path / 'trace.jsonl')
+    with FileTrace(path, batch_size=2) as trace:
+        t = word_count_task(verbose=trace)
+        assert list(t(["a b a"])) == [('a', 2), ('b', 1)]
+    with open(path) as f:
+        events = [json.loads(line) for line in f]
+    assert [e['step'] for e in events] == ['m1'] * 3 + ['r1'] * 2
+    assert events[-1]['output'] == "('b', 1)"
+
+
+def test_stats():
+    for lazy in [False, True]:
+        t = MapReduceTask(verbose=False, lazy=lazy, collect_stats=True)
+
+        @t.map
+        def m1(k, v):
+            for word in v.split(' '):
+                yield word, 1
+
+        with t.repeated(2) as repeated:
+            @repeated.reduce
+            def r1(k, v):
+                yield k, sum(v)
+
+            with repeated.discarded(verbose=False) as discarded:
+                @discarded.map
+                def m2(k, v):
+                    yield 'all', v
+
+        assert list(t(["a b a c", "a b"])) == [('a', 3), ('b', 2), ('c', 1)]
+        m1_stats, repeated_stats = t.stats()
+        assert (m1_stats['step'], m1_stats['input'], m1_stats['output']) == ('m1', 2, 6)
+        assert m1_stats['wall'] >= 0 and m1_stats['cpu'] >= 0
+        assert repeated_stats['kind'] == 'repeated'
+        first, second = repeated_stats['iterations']
+        assert first[0]['keys'] == 3
+        assert first[0]['group_sizes'] == {1: 1, 2: 2}
+        assert first[0]['top_keys'][0] == ('a', 3)
+        assert second[0]['group_sizes'] == {1: 3}
+        assert first[1]['kind'] == 'discarded'
+        if not lazy:
+            assert first[1]['steps'][0]['output'] == 3
+        assert repeated.stats() == repeated_stats['iterations']
+
+
+def test_stats_disabled():
+    t = word_count_task(verbose=False)
+    list(t(["a b"]))
+    assert t.stats() == []
+
+
+def test_async_map_reduce():
+    import asyncio
+    running = 0
+    max_running = 0
+
+    t = MapReduceTask(verbose=True)
+
+    @t.map(concurrency=4)
+    async def m1(k, v):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01 * (v % 3))
+        running -= 1
+        return [(v % 2, v)]
+
+    @t.reduce
+    async def r1(k, v):
+        await asyncio.sleep(0)
+        yield k, sum(v)
+
+    print('')
+    assert list(t(range(10))) == [(0, 20), (1, 25)]
+    assert max_running == 4
+
+
+def test_async_map_unordered():
+    import asyncio
+    t = MapReduceTask(verbose=False, lazy=True)
+
+    @t.map(concurrency=10, ordered=False)
+    async def m1(k, v):
+        await asyncio.sleep(0.01 * v)
+        yield k, v
+
+    assert [v for k, v in t([3, 1, 2, 0])] == [0, 1, 2, 3]
+
+
+def test_async_map_in_running_loop():
+    import asyncio
+    # the task is called from a coroutine (e.g. a request handler)
+    t = MapReduceTask(verbose=False)
+
+    @t.map(concurrency=4)
+    async def m1(k, v):
+        await asyncio.sleep(0.001)
+        return [(v % 2, v)]
+
+    t.aggregate('sum')
+
+    async def handler():
+        return t(range(10))
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(handler()) == [(0, 20), (1, 25)]
+    finally:
+        loop.close()
+
+
+def test_async_map_error():
+    t = MapReduceTask(verbose=False)
+
+    @t.map
+    async def m1(k, v):
+        if v == 2:
+            raise ValueError(v)
+        return [(k, v)]
+
+    try:
+        t(range(5))
+    except ValueError:
+        pass
+    else:
+        assert False, "error in the async function should be raised"
+
+
+def test_broadcast_page_rank():
+    # workers and partitions are forked processes, which need the broadcast built
+    for options in [{}, {'lazy': True}, {'lazy': True, 'workers': 2}, {'lazy': True, 'partitions': 2}]:
+        t = MapReduceTask(verbose=False, **options)
+        calls = 0
+
+        @t.broadcast
+        def links(k, v):
+            nonlocal calls
+            calls += 1
+            url, outgoing = v
+            yield url, outgoing
+
+        @t.map
+        def m0(k, v):
+            yield v[0], 1 / N
+
+        with t.repeated(4) as repeated:
+            # only the ranks are shuffled, the links are looked up in the broadcast
+            @repeated.map
+            def m1(url, rank):
+                yield url, 0
+                for target in links[url]:
+                    yield target, rank / len(links[url])
+
+            @repeated.reduce
+            def r1(url, values):
+                yield url, alpha / N + (1 - alpha) * sum(values)
+
+        N = 4
+        alpha = 0.5
+        x = {
+            'p1': ['p2', 'p3', 'p4'],
+            'p2': ['p1'],
+            'p3': ['p2'],
+            'p4': ['p2'],
+        }
+        answer = dict(t(x.items()))
+        expected = {p: 1 / N for p in x}
+        for _ in range(4):
+            contributions = {p: 0 for p in x}
+            for p, outgoing in x.items():
+                for target in outgoing:
+                    contributions[target] += expected[p] / len(outgoing)
+            expected = {p: alpha / N + (1 - alpha) * c for p, c in contributions.items()}
+        for page, rank in answer.items():
+            assert abs(rank - expected[page]) < 1e-9
+        assert calls == 4
+        assert links['p1'] == ['p2', 'p3', 'p4']
+
+
+def test_broadcast_multi():
+    from mapreduce import Broadcast
+    t = MapReduceTask(verbose=False)
+
+    @t.broadcast(multi=True)
+    def by_parity(k, v):
+        yield v % 2, v
+
+    assert isinstance(by_parity, Broadcast)
+    try:
+        by_parity[0]
+    except RuntimeError:
+        pass
+    else:
+        assert False, "broadcast should not be used before it's built"
+
+    @t.map
+    def m1(k, v):
+        yield v, sum(by_parity[v % 2])
+
+    assert list(t(range(4))) == [(0, 2), (1, 4), (2, 2), (3, 4)]
+
+
+def test_delta_repeated_bfs():
+    t = MapReduceTask(verbose=True, collect_stats=True)
+
+    @t.map
+    def m1(k, v):
+        n, neighbors = v
+        state = 1 if n == 'x' else 0
+        yield n, (state, neighbors)
+
+    # no discarded block to check for the end, it stops when nothing changes
+    with t.delta_repeated() as repeated:
+        @repeated.reduce
+        def r1(n, l):
+            state = 0
+            neighbors = []
+            for i in l:
+                state = max(state, i[0])  # i.state
+                neighbors += i[1]  # i.neighbors
+            if state == 1:
+                for o in neighbors:
+                    yield o, (1, [])
+                state = 2
+            yield n, (state, neighbors)
+
+    x = {
+        'x': ['a', 'b', 'c'],
+        'a': ['e'],
+        'b': ['d'],
+        'c': ['d', 'x'],
+        'f': ['x'],
+    }
+    print('')
+    assert sorted(t(x.items())) == [
+        ('a', (2, ['e'])),
+        ('b', (2, ['d'])),
+        ('c', (2, ['d', 'x'])),
+        ('d', (2, [])),
+        ('e', (2, [])),
+        ('f', (0, ['x'])),
+        ('x', (2, ['a', 'b', 'c'])),
+    ]
+    inputs = [iteration[0]['input'] for iteration in repeated.stats()]
+    assert inputs[0] == 5
+    assert 'f' not in [k for k, n in repeated.stats()[1][0]['top_keys']]
+    assert inputs[-1] < inputs[1]
+
+
+def test_delta_repeated_changed():
+    t = MapReduceTask(verbose=False)
+
+    with t.delta_repeated(changed=lambda old, new: abs(old[0] - new[0]) > 0.01) as repeated:
+        @repeated.map
+        def halve(k, v):
+            yield k, v / 2
+
+    assert list(t([1, 10])) == [(0, 0.0078125), (1, 0.009765625)]
+
+
+def counter_task(checkpoint_dir, crash_at=None, lazy=False):
+    t = MapReduceTask(verbose=False, lazy=lazy, checkpoint_dir=checkpoint_dir, checkpoint_every=2)
+    calls = {'m0': 0, 'm1': 0}
+
+    @t.map
+    def m0(k, v):
+        calls['m0'] += 1
+        yield v, 0
+
+    with t.repeated(6) as repeated:
+        @repeated.map
+        def m1(k, v):
+            calls['m1'] += 1
+            if calls['m1'] == crash_at:
+                raise KeyboardInterrupt
+            yield k, v + 1
+
+    return t, calls
+
+
+def test_checkpoint_resume(tmp_path):
+    for lazy in [False, True]:
+        directory = str(tmp_path / str(lazy))
+        t, calls = counter_task(directory, crash_at=10, lazy=lazy)
+        try:
+            list(t(['a', 'b']))
+        except KeyboardInterrupt:
+            pass
+        else:
+            assert False, "should crash in the 5th iteration"
+
+        t, calls = counter_task(directory, lazy=lazy)
+        assert list(t(['a', 'b'], resume=True)) == [('a', 6), ('b', 6)]
+        assert calls == {'m0': 0, 'm1': 4}  # resumed after the 4th iteration
+
+        t, calls = counter_task(directory, lazy=lazy)
+        assert list(t(['a', 'b'])) == [('a', 6), ('b', 6)]
+        assert calls == {'m0': 2, 'm1': 12}
+
+
+def test_checkpoint_resume_delta(tmp_path):
+    calls = 0
+
+    def task():
+        t = MapReduceTask(verbose=False, checkpoint_dir=str(tmp_path))
+        with t.delta_repeated(3) as repeated:
+            @repeated.map
+            def m1(k, v):
+                nonlocal calls
+                calls += 1
+                yield k, min(v + 1, 5)
+        return t
+
+    assert list(task()([0, 4])) == [(0, 3), (1, 5)]
+    assert calls == 5
+    # all 3 iterations are in the checkpoint, nothing runs again
+    assert list(task()([0, 4], resume=True)) == [(0, 3), (1, 5)]
+    assert calls == 5
+
+
+def cached_task(cache, factor):
+    t = MapReduceTask(verbose=False, cache=cache, collect_stats=True)
+
+    @t.map
+    def split(k, v):
+        for w in v.split():
+            yield w, 1
+
+    @t.reduce
+    def count(k, values):
+        yield k, sum(values)
+
+    @t.map
+    def scale(k, v):
+        yield k, v * factor
+
+    return t
+
+
+def steps_run(t):
+    return [s['step'] for s in t.stats()]
+
+
+def test_stage_cache(tmp_path):
+    from mapreduce import StageCache
+    cache = StageCache(str(tmp_path))
+    lines = ['a b', 'b']
+    t = cached_task(cache, 1)
+    assert t(lines) == [('a', 1), ('b', 2)]
+    assert steps_run(t) == ['split', 'count', 'scale']
+    # only the last step changes, the output of the reduce is reused
+    t = cached_task(cache, 10)
+    assert t(lines) == [('a', 10), ('b', 20)]
+    assert steps_run(t) == ['scale']
+    # other input
+    t = cached_task(cache, 10)
+    assert t(['c']) == [('c', 10)]
+    assert steps_run(t) == ['split', 'count', 'scale']
+
+    t = cached_task(cache, 10)
+    t.invalidate_cache(lines)
+    assert t(lines) == [('a', 10), ('b', 20)]
+    assert steps_run(t) == ['split', 'count', 'scale']
+
+
+def test_stage_cache_top(tmp_path):
+    from mapreduce import StageCache
+    cache = StageCache(str(tmp_path))
+    for n in [1, 1, 2]:
+        t = cached_task(cache, 1)
+        t.top(n, key=lambda record: record[1])
+        assert t(['a b', 'b']) == [('b', 2), ('a', 1)][:n]
+    # the key function is fingerprinted by its code, not by its address
+    assert len(os.listdir(str(tmp_path))) == 5
+
+
+SCALE = 1
+
+
+def scaled(k, v):
+    yield k, v * SCALE
+
+
+def test_stage_cache_captured_values(tmp_path):
+    from mapreduce import StageCache
+    global SCALE
+    cache = StageCache(str(tmp_path))
+
+    def nearest_task(centroids):
+        t = MapReduceTask(verbose=False, cache=cache, collect_stats=True)
+
+        @t.map
+        def nearest(k, v):
+            yield min(range(len(centroids)), key=lambda i: abs(v - centroids[i])), v
+
+        t.map(scaled)
+        return t
+
+    assert nearest_task([0, 10])([1, 4]) == [(0, 1), (0, 4)]
+    # a captured list and a global are fingerprinted by their content
+    assert nearest_task([0, 5])([1, 4]) == [(0, 1), (1, 4)]
+    t = nearest_task([0, 10])
+    assert t([1, 4]) == [(0, 1), (0, 4)] and steps_run(t) == []
+    try:
+        SCALE = 100
+        assert nearest_task([0, 10])([1, 4]) == [(0, 100), (0, 400)]
+    finally:
+        SCALE = 1
+
+    # a value which can't be pickled, the step and the ones after it aren't cached
+    t = MapReduceTask(verbose=False, cache=cache, collect_stats=True)
+    functions = [lambda v: v + 1]
+
+    @t.map
+    def apply(k, v):
+        yield k, functions[0](v)
+
+    for _ in range(2):
+        assert t([1]) == [(0, 2)]
+        assert steps_run(t) == ['apply']
+
+
+def test_stage_cache_eviction(tmp_path):
+    from mapreduce import StageCache
+    cache = StageCache(str(tmp_path), max_bytes=0)
+    assert cached_task(cache, 1)(['a']) == [('a', 1)]
+    assert os.listdir(str(tmp_path)) == []
+    cache = StageCache(str(tmp_path))
+    cached_task(cache, 1)(['a'])
+    assert len(os.listdir(str(tmp_path))) == 3
+    cache.clear()
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_text_source_splits(tmp_path):
+    from mapreduce import TextSource
+    path = str(tmp_path / 'lines.txt')
+    with open(path, 'wb') as f:
+        f.write(b'a b\r\n\nccc d\ne')
+    assert list(TextSource(path)) == [(0, 'a b'), (5, ''), (6, 'ccc d'), (12, 'e')]
+    for split_size in range(1, 15):
+        source = TextSource(path, split_size=split_size)
+        records = [r for start, end in source.splits() for r in source.read(start, end)]
+        assert records == list(source)
+
+
+def test_file_sources(tmp_path):
+    from mapreduce import JsonLinesSource, CsvSource, BinarySource
+    path = str(tmp_path / 'records')
+    with open(path, 'w') as f:
+        f.write('{"a": 1}\n{"a": 2}\n')
+    assert list(JsonLinesSource(path, split_size=4)) == [(0, {'a': 1}), (9, {'a': 2})]
+
+    with open(path, 'w') as f:
+        f.write('x,y\n1,"a,b"\n2,c\n')
+    assert list(CsvSource(path)) == [(0, ['x', 'y']), (4, ['1', 'a,b']), (12, ['2', 'c'])]
+    source = CsvSource(path, header=True, split_size=5)
+    records = [r for start, end in source.splits() for r in source.read(start, end)]
+    assert records == [(4, {'x': '1', 'y': 'a,b'}), (12, {'x': '2', 'y': 'c'})]
+
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<3i', 1, 2, 3) + b'\x00')
+    assert list(BinarySource(path, format='<i', split_size=5)) == [(0, (1,)), (4, (2,)), (8, (3,))]
+    source = BinarySource(path, record_size=4, split_size=5)
+    assert source.splits() == [(0, 4), (4, 8), (8, 12), (12, 13)]
+    assert list(source.read(4, 8)) == [(4, struct.pack('<i', 2))]
+
+
+def test_file_source_workers(tmp_path):
+    from mapreduce import TextSource
+    path = str(tmp_path / 'lines.txt')
+    with open(path, 'w') as f:
+        f.write('a b\nb c\n' * 50)
+    expected = sorted(word_count_task()(['a b', 'b c'] * 50))
+    for workers in [None, 2]:
+        t = word_count_task(workers=workers)
+        assert sorted(t(TextSource(path, split_size=64))) == expected
+
+
+def test_sinks(tmp_path):
+    from mapreduce import JsonLinesSink, CsvSink, BinarySink, read_records
+    lines = ['a b', 'b c', 'c d']
+    expected = sorted(word_count_task(verbose=False)(lines))
+
+    paths = word_count_task(verbose=False, lazy=True)(lines, sink=JsonLinesSink(str(tmp_path / 'json')))
+    assert [os.path.basename(p) for p in paths] == ['part-00000.jsonl']
+    with open(paths[0]) as f:
+        assert sorted(tuple(json.loads(line)) for line in f) == expected
+
+    t = word_count_task(verbose=False)
+    paths = t(lines, sink=BinarySink(str(tmp_path / 'bin'), partitions=3))
+    assert len(paths) == 3
+    parts = [list(read_records(p)) for p in paths]
+    assert sorted(r for part in parts for r in part) == expected
+    # the same key always goes to the same file
+    assert parts == [list(read_records(p)) for p in t(lines, sink=BinarySink(str(tmp_path / 'bin'), partitions=3))]
+
+    paths = t(lines, sink=CsvSink(str(tmp_path / 'csv'), boundaries=['b', 'c']))
+    assert [open(p).read() for p in paths] == ['a,1\n', 'b,2\n', 'c,2\nd,1\n']
+
+
+Point = namedtuple('Point', 'x y')
+
+
+def test_serializer():
+    import io
+    from mapreduce import Serializer
+    records = [('a', 1), (2, (1.5, [None, True])), ((1, 2), b'x')]
+    for serializer in [Serializer(), Serializer('marshal'), Serializer(compression='zlib'), Serializer(compression='lzma')]:
+        assert serializer.loads(serializer.dumps(records)) == records
+        # not marshallable, pickled
+        assert serializer.loads(serializer.dumps([Point(1, 2)])) == [Point(1, 2)]
+        f = io.BytesIO()
+        serializer.write_frame(f, records)
+        serializer.write_frame(f, [])
+        f.seek(0)
+        assert list(serializer.read_frames(f)) == [records, []]
+    with pytest.raises(ValueError):
+        Serializer(compression='zip')
+
+
+def test_persistent_serializer(tmp_path):
+    from mapreduce import Serializer, StageCache, StateStore
+    from mapreduce.mapreduce import save_checkpoint, load_checkpoint
+    # marshal's format can change between Python versions, what is stored is pickled
+    serializer = Serializer('marshal', compression='zlib')
+    assert serializer.persistent.codec == 'pickle'
+    assert serializer.persistent.compression == 'zlib'
+    assert Serializer().persistent.codec == 'pickle'
+    save_checkpoint(str(tmp_path), 1, {'x': [('a', 1)]}, serializer=serializer)
+    with open(str(tmp_path / 'checkpoint-00000001'), 'rb') as f:
+        assert zlib.decompress(f.read())[:1] == b'p'
+    assert load_checkpoint(str(tmp_path), serializer) == {'x': [('a', 1)]}
+    for stored in [StageCache(str(tmp_path / 'cache'), serializer=serializer),
+                   StateStore(str(tmp_path / 'state.db'), serializer=serializer)]:
+        assert stored.serializer.codec == 'pickle'
+
+
+def test_spill_serializer():
+    from mapreduce import Serializer
+    lines = ['a b', 'b c', 'c d'] * 10
+    expected = sorted(word_count_task(verbose=False)(lines))
+    for serializer in [Serializer('marshal'), Serializer(compression='bz2')]:
+        t = word_count_task(verbose=False, spill_threshold=4, serializer=serializer)
+        assert sorted(t(lines)) == expected
+
+
+def naive_join(left, right, how):
+    result = []
+    right_keys = {k for k, _ in right}
+    left_keys = {k for k, _ in left}
+    for k, v in left:
+        if k in right_keys:
+            result += [(k, (v, w)) for k2, w in right if k2 == k]
+        elif how in ('left', 'outer'):
+            result.append((k, (v, None)))
+    if how in ('right', 'outer'):
+        result += [(k, (None, w)) for k, w in right if k not in left_keys]
+    return sorted(result, key=repr)
+
+
+def test_join():
+    left = [(2, 3), (2, 4), (3, 6), (3, 5), (0, 1), (1, 2)]
+    right = [(2, 2), (2, 3), (3, 3), (3, 4), (3, 5), (1, 0), (7, 7)]
+    for how in ['inner', 'left', 'right', 'outer']:
+        for strategy, options in [('hash', {}), ('sort_merge', {}), ('sort_merge', {'spill_threshold': 2}),
+                                  ('auto', {}), ('auto', {'lazy': True})]:
+            t = MapReduceTask(verbose=False, **options)
+            t.join('s', 'r', how=how, strategy=strategy)
+
+            @t.map
+            def swap(k, v):
+                yield k, (v[1], v[0])
+
+            result = t({'s': iter(left), 'r': iter(right)})
+            expected = [(k, (w, v)) for k, (v, w) in naive_join(left, right, how)]
+            assert sorted(result, key=repr) == sorted(expected, key=repr)
+
+
+def test_join_auto_strategy():
+    left = [('hot', i) for i in range(300)] + [('cold', 0)]
+    right = [('hot', i) for i in range(200)]
+    for threshold in [10, 1000]:
+        t = MapReduceTask(verbose=False, collect_stats=True)
+        t.join('a', 'b', broadcast_threshold=threshold)
+        result = t({'a': left, 'b': right})
+        assert len(result) == 300 * 200
+        assert t.stats()[0]['output'] == 300 * 200
+
+    with pytest.raises(ValueError):
+        t.join('a', 'b')  # not the first step
+    with pytest.raises(ValueError):
+        MapReduceTask().join('a', 'b', how='cross')
+
+
+def test_hot_key_salting():
+    lines = ['a b'] * 100 + ['c']
+    for options in [{}, {'partitions': 3}, {'spill_threshold': 7}, {'lazy': True}]:
+        group_sizes = []
+        t = MapReduceTask(verbose=False, hot_key_threshold=10, **options)
+
+        @t.map
+        def m1(k, v):
+            for word in v.split(' '):
+                yield word, 1
+
+        @t.reduce(associative=True)
+        def r1(k, values):
+            values = list(values)
+            group_sizes.append(len(values))
+            yield k, sum(values)
+
+        assert sorted(t(lines)) == [('a', 100), ('b', 100), ('c', 1)]
+        if 'partitions' not in options:  # reduced in other processes
+            assert max(group_sizes) <= 20
+
+
+def test_hot_key_not_associative():
+    t = MapReduceTask(verbose=False, hot_key_threshold=10)
+
+    @t.map
+    def m1(k, v):
+        yield 'all', v
+
+    @t.reduce
+    def r1(k, values):
+        yield k, len(list(values))
+
+    assert t(range(100)) == [('all', 100)]
+
+
+def test_sort_values():
+    records = [('b', 3), ('a', 5), ('b', 1), ('a', 2), ('b', 2), ('a', 9), ('c', 0)]
+    for options in [{}, {'spill_threshold': 2}, {'partitions': 2}, {'lazy': True}]:
+        for reverse in [False, True]:
+            t = MapReduceTask(verbose=False, **options)
+
+            @t.map
+            def m1(k, v):
+                yield v
+
+            @t.reduce(sort_values_by=lambda v: v, reverse=reverse)
+            def top2(k, values):
+                yield k, list(itertools.islice(values, 2))
+
+            expected = {'b': [1, 2], 'a': [2, 5], 'c': [0]}
+            if reverse:
+                expected = {'b': [3, 2], 'a': [9, 5], 'c': [0]}
+            assert list(t(records)) == list(expected.items())  # keys in the order of their first records
+
+
+def test_sort_values_by_key():
+    t = MapReduceTask(verbose=False)
+
+    @t.map
+    def m1(k, v):
+        yield 'all', (k, v)
+
+    @t.reduce(sort_values_by=itemgetter(1), reverse=True)
+    def r2(k, values):
+        yield next(values)
+
+    assert t([3, 7, 5]) == [(1, 7)]
+    with pytest.raises(ValueError):
+        t.reduce(sort_values_by=itemgetter(1), agg='sum')
+
+
+def test_take():
+    calls = Counter()
+    t = MapReduceTask(verbose=False)
+
+    @t.map
+    def m1(k, v):
+        calls['m1'] += 1
+        yield k, v * 2
+
+    @t.map
+    def m2(k, v):
+        if v % 3:
+            yield k, v
+
+    t.take(3)
+    # an infinite input, only the needed records are read
+    assert t(itertools.count()) == [(1, 2), (2, 4), (4, 8)]
+    assert calls['m1'] == 5
+
+    t = word_count_task(verbose=False)
+
+    @t.reduce
+    def r2(k, values):
+        calls['r2'] += 1
+        yield values
+
+    t.take(2)
+    assert len(t(['a b', 'c d e'])) == 2
+    assert calls['r2'] == 2
+
+
+def test_top():
+    lines = ['a b b', 'c b a', 'd']
+    for options in [{}, {'partitions': 2}, {'lazy': True}, {'collect_stats': True}]:
+        t = word_count_task(verbose=False, **options)
+        t.top(2, key=itemgetter(1))
+        assert t(lines) == [('b', 3), ('a', 2)]
+
+    t = MapReduceTask(verbose=False)
+    t.top(3)
+    assert t(range(10)) == [(9, 9), (8, 8), (7, 7)]
+
+    # ties keep the first records, with partitions too
+    for options in [{}, {'partitions': 2}, {'partitions': 3}]:
+        t = word_count_task(verbose=False, **options)
+        t.top(2, key=itemgetter(1))
+        assert t(['a b c d e f g h']) == [('a', 1), ('b', 1)]
+
+
+def test_pipeline():
+    lines = ['a b', 'b c', 'c d'] * 20
+    expected = sorted(word_count_task(verbose=False)(lines))
+    for options in [{'pipeline': 'thread'}, {'pipeline': 'process'}, {'pipeline': 'thread', 'lazy': True},
+                    {'pipeline': 'process', 'chunksize': 7, 'queue_size': 1},
+                    {'pipeline': 'thread', 'collect_stats': True}]:
+        t = word_count_task(verbose=False, **options)
+        assert sorted(t(lines)) == expected
+    assert [s['step'] for s in t.stats()] == ['m1', 'r1']
+
+    t = MapReduceTask(verbose=False, pipeline='thread', chunksize=1)
+
+    @t.map
+    def m1(k, v):
+        yield k, v + 1
+
+    t.take(3)
+    assert t(itertools.count()) == [(0, 1), (1, 2), (2, 3)]
+
+    with pytest.raises(ValueError):
+        MapReduceTask(pipeline='fibers')
+
+
+def test_pipeline_error():
+    for pipeline in ['thread', 'process']:
+        t = MapReduceTask(verbose=False, pipeline=pipeline)
+
+        @t.map
+        def m1(k, v):
+            if v == 5:
+                raise KeyError(v)
+            yield k, v
+
+        @t.reduce
+        def r1(k, v):
+            yield k, v
+
+        with pytest.raises(KeyError):
+            t(range(10))
+
+
+def test_pipeline_process_trace(tmp_path):
+    from mapreduce import FileTrace, RingBufferTrace
+    # the trace sinks would be copied into the stage processes
+    with FileTrace(str(tmp_path / 'trace.jsonl'), batch_size=1) as file_trace:
+        for trace in [file_trace, RingBufferTrace()]:
+            t = word_count_task(verbose=trace, pipeline='process')
+            with pytest.raises(ValueError):
+                t(['a b', 'b'])
+    trace = RingBufferTrace()
+    assert word_count_task(verbose=trace, pipeline='thread')(['a b', 'b']) == [('a', 1), ('b', 2)]
+    assert len(trace.events) == 5
+
+
+def test_pipeline_overlap():
+    import threading
+    # the first step waits for the second one to get its first record, which only works
+    # when they run at the same time
+    second_started = threading.Event()
+    overlapped = []
+    t = MapReduceTask(verbose=False, pipeline='thread', chunksize=1, fuse=False)
+
+    @t.map
+    def first(k, v):
+        if k == 1:
+            overlapped.append(second_started.wait(timeout=10))
+        yield k, v
+
+    @t.map
+    def second(k, v):
+        second_started.set()
+        yield k, v
+
+    assert t(range(3)) == [(0, 0), (1, 1), (2, 2)]
+    assert overlapped == [True]
+
+
+def test_pipeline_process_killed():
+    t = MapReduceTask(verbose=False, pipeline='process', chunksize=1, fuse=False)
+
+    @t.map
+    def m1(k, v):
+        if v == 3:
+            os._exit(1)
+        yield k, v
+
+    @t.map
+    def m2(k, v):
+        yield k, v
+
+    with pytest.raises(RuntimeError, match='stage 0 exited with code 1'):
+        t(range(10))
+
+
+def test_stream_count_windows():
+    def task():
+        t = word_count_task(verbose=False)
+
+        @t.map
+        def m2(k, v):
+            yield k, v * 10
+        return t
+
+    lines = ['a b', 'b', 'c', 'a', 'a']
+    windows = [(start, end, sorted(output)) for start, end, output in task().stream(lines, 2)]
+    assert windows == [(0, 2, [('a', 10), ('b', 20)]), (2, 4, [('a', 10), ('c', 10)]), (4, 6, [('a', 10)])]
+
+    windows = [(start, end, sorted(output)) for start, end, output in task().stream(lines, 4, slide=2)]
+    assert windows == [
+        (0, 2, [('a', 10), ('b', 20)]),
+        (0, 4, [('a', 20), ('b', 20), ('c', 10)]),
+        (2, 6, [('a', 20), ('c', 10)]),
+        (4, 8, [('a', 10)]),
+    ]
+
+    # an endless input, a window is emitted as soon as it's complete
+    stream = task().stream(itertools.cycle(['x']), 3)
+    assert next(stream) == (0, 3, [('x', 30)])
+    assert next(stream) == (3, 6, [('x', 30)])
+
+    with pytest.raises(ValueError):
+        task().stream(lines, 3, slide=2)
+
+
+def test_stream_repeated():
+    # the repeated block runs twice in every window
+    t = MapReduceTask(verbose=False)
+
+    @t.map
+    def m1(k, v):
+        yield v, 2
+
+    with t.repeated(2) as repeated:
+        @repeated.map
+        def double(k, v):
+            yield k, v * 2
+
+    assert list(t.stream(['a', 'b'], 1)) == [(0, 1, [('a', 8)]), (1, 2, [('b', 8)])]
+    assert list(t(['c'])) == [('c', 8)]
+
+
+def test_stream_time_windows():
+    import time
+    events = [(0.5, 'a'), (1.2, 'a b'), (1.9, 'b'), (7.1, 'c'), (6.0, 'late')]
+    t = word_count_task(verbose=False)
+    values = dict((v, ts) for ts, v in events)
+    windows = [(start, end, sorted(output)) for start, end, output in
+               t.stream([v for _, v in events], 2, slide=1, by='time', timestamp=values.get)]
+    assert windows == [
+        (-1, 1, [('a', 1)]),
+        (0, 2, [('a', 2), ('b', 2)]),
+        (1, 3, [('a', 1), ('b', 2)]),
+        (6, 8, [('c', 1), ('late', 1)]),
+        (7, 9, [('c', 1), ('late', 1)]),
+    ]
+
+    # by arrival time, windows are closed by the clock
+    def slow():
+        yield 'a'
+        time.sleep(0.25)
+        yield 'b'
+
+    windows = list(t.stream(slow(), 0.1, by='time'))
+    assert [output for _, _, output in windows] == [[('a', 1)], [('b', 1)]]
+    assert all(end - start == pytest.approx(0.1, abs=1e-3) for start, end, _ in windows)
+
+
+def test_incremental(tmp_path):
+    from mapreduce import StateStore
+
+    def task(state, associative):
+        t = MapReduceTask(verbose=False, state=state)
+
+        @t.map
+        def m1(k, v):
+            for word in v.split(' '):
+                yield word, 1
+
+        if associative:
+            @t.reduce(associative=True)
+            def r1(k, values):
+                yield k, sum(values)
+        else:
+            t.aggregate('sum', 'mean')
+
+        @t.map
+        def m2(k, v):
+            yield k, v
+        return t
+
+    days = [['a b', 'b c'], ['c d'], ['a a']]
+    for associative in [True, False]:
+        state = StateStore(str(tmp_path / 'state{}.db'.format(associative)))
+        history = []
+        for day in days:
+            output = task(state, associative)(day)
+            history += day
+            expected = dict(word_count_task(verbose=False)(history))
+            # only the keys of the new records
+            assert {k for k, _ in output} == {w for line in day for w in line.split(' ')}
+            if associative:
+                assert all(expected[k] == v for k, v in output)
+        results = dict(task(state, associative).results())
+        if associative:
+            assert results == {'a': 3, 'b': 2, 'c': 2, 'd': 1}
+        else:
+            assert results == {'a': (3, 1), 'b': (2, 1), 'c': (2, 1), 'd': (1, 1)}
+        assert len(state) == 4
+        state.close()
+
+        # the state is persisted
+        state = StateStore(str(tmp_path / 'state{}.db'.format(associative)))
+        assert dict(task(state, associative)(['d'])) == ({'d': 2} if associative else {'d': (2, 1)})
+
+
+def test_incremental_not_supported(tmp_path):
+    from mapreduce import StateStore
+    t = word_count_task(verbose=False, state=StateStore(str(tmp_path / 'state.db')))
+    with pytest.raises(ValueError):
+        t(['a'])  # not associative
+
+
+def test_batch_aggregate():
+    np = pytest.importorskip('numpy')
+    from mapreduce import Columns
+    records = [(k % 3, float(k)) for k in range(10)]
+    for lazy in [False, True]:
+        t = MapReduceTask(verbose=False, lazy=lazy, chunksize=4)
+
+        @t.map
+        def m1(k, v):
+            yield v
+
+        t.aggregate_batch('sum', 'count', 'min', 'max', 'mean')
+        output = t(records)
+        assert isinstance(output, Columns)
+        assert list(output) == [(0, (18.0, 4.0, 0.0, 9.0, 4.5)), (1, (12.0, 3.0, 1.0, 7.0, 4.0)),
+                                (2, (15.0, 3.0, 2.0, 8.0, 5.0))]
+
+    t = MapReduceTask(verbose=False)
+    t.aggregate_batch('sum')
+    keys, values = t(Columns(np.array([5, 1, 5]), np.array([1, 2, 3]))).concatenated()
+    assert keys.tolist() == [1, 5] and values.tolist() == [2, 4]
+    assert list(t(Columns(np.array([], dtype=int), np.array([])))) == []
+
+
+def test_batch_matrix_product():
+    np = pytest.importorskip('numpy')
+    # (i, j) -> a[i][j] and (j, k) -> b[j][k], vectorized
+    a = np.array([[1, 2], [3, 4]])
+    b = np.array([[5, 6], [7, 8]])
+    t = MapReduceTask(verbose=False)
+
+    @t.map_batch
+    def products(keys, values):
+        i, j, k = values[:, 0], values[:, 1], values[:, 2]
+        return np.column_stack([i, k]), a[i, j] * b[j, k]
+
+    t.aggregate_batch('sum')
+
+    @t.map
+    def m2(k, v):
+        yield k, int(v)
+
+    cells = [(i, j, k) for i in range(2) for j in range(2) for k in range(2)]
+    assert t(cells) == [((0, 0), 19), ((0, 1), 22), ((1, 0), 43), ((1, 1), 50)]
+
+
+def test_batch_reduce_order():
+    np = pytest.importorskip('numpy')
+    t = MapReduceTask(verbose=False, chunksize=2)
+
+    @t.map
+    def m1(k, v):
+        yield v, k
+
+    @t.reduce_batch
+    def first(keys, values, starts):
+        return keys, values[starts]  # the first value of every key, in the input order
+
+    assert list(t(['b', 'a', 'b', 'a', 'c'])) == [('a', 1), ('b', 0), ('c', 4)]
+
+
+def test_partition_process_killed():
+    t = MapReduceTask(verbose=False, partitions=2)
+
+    @t.map
+    def m1(k, v):
+        yield v, 1
+
+    @t.reduce
+    def r1(k, values):
+        if k == 3:
+            os._exit(1)  # like an OOM kill, no error is sent
+        yield k, sum(values)
+
+    with pytest.raises(RuntimeError, match='exited with code 1'):
+        t(range(10))